@@ -6,6 +6,8 @@ from __future__ import unicode_literals, print_function
 
 import os
 import sys
+import json
+import inspect
 import traceback
 import bottle
 
@@ -15,6 +17,18 @@ __url__ = 'http://github.com/olemb/bottle_jsonrpc/'
 __license__ = 'MIT'
 __version__ = '0.2.0'
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
 
 def get_public_methods(obj):
     """Return a dictionary of all public callables in a namespace.
@@ -50,30 +64,82 @@ class NameSpace:
         """Sets up bottle request handler."""
         @self.app.post(self.path)
         def rpc():
-            request = bottle.request.json
-            
             try:
-                name = request['method']
-                func = self.methods[name]
-                if 'params' in request:
-                    result = func(*request['params'])
-
-                return {
-                    'id': request['id'],
-                    'result': result,
-                    'error': None,
-                }                
-            except:
-                traceback.print_exc(file=sys.stderr)
-                response = { 
-                    'id': request['id'],
-                    'result': None,
-                    'error': 'Internal server error',
+                request = bottle.request.json
+            except ValueError:
+                return self._reply(self._error(None, PARSE_ERROR, 'Parse error'))
+
+            if isinstance(request, list):
+                # JSON-RPC 2.0 batch: the calls are run in order within
+                # this one HTTP request, and answered with an array of the
+                # responses to those which aren't notifications.
+                if not request:
+                    return self._reply(self._error(None, INVALID_REQUEST, 'Invalid Request'))
+
+                responses = [self._call(r) for r in request]
+                return self._reply([r for r in responses if r is not None] or None)
+
+            return self._reply(self._call(request))
+
+    def _reply(self, response):
+        """Sends `response', or nothing at all for notifications."""
+        if response is None:
+            bottle.response.status = 204
+            return ''
+
+        bottle.response.content_type = 'application/json'
+        return json.dumps(response)
+
+    def _call(self, request):
+        """Runs one {method, params, id} call and returns the response, or
+        None if it was a notification (a call without id)."""
+        if not isinstance(request, dict) or not isinstance(request.get('method'), string_types):
+            return self._error(None, INVALID_REQUEST, 'Invalid Request')
+
+        notification = 'id' not in request
+        params = request.get('params', [])
+
+        func = self.methods.get(request['method'])
+        if func is None:
+            response = self._error(request, METHOD_NOT_FOUND, 'Method not found')
+        elif not isinstance(params, (list, dict)):
+            response = self._error(request, INVALID_PARAMS, 'Invalid params')
+        else:
+            args, kwargs = (params, {}) if isinstance(params, list) else ([], params)
+            try:
+                inspect.getcallargs(func, *args, **kwargs)
+            except TypeError as e:
+                response = self._error(request, INVALID_PARAMS, 'Invalid params: {0}'.format(e))
+            else:
+                try:
+                    response = {
+                        'jsonrpc': '2.0',
+                        'id': request.get('id'),
+                        'result': func(*args, **kwargs),
                     }
-                if bottle.debug:
-                    response['traceback'] = traceback.format_exc()
-
-                return response
+                except:
+                    # The traceback goes to the server's log, not the client
+                    traceback.print_exc(file=sys.stderr)
+                    response = self._error(request, INTERNAL_ERROR, 'Internal error')
+
+        if notification:
+            return None
+        return response
+
+    def _error(self, request, code, message):
+        try:
+            id = request['id']
+        except:
+            id = None
+
+        return {
+            'jsonrpc': '2.0',
+            'id': id,
+            'error': {
+                'code': code,
+                'message': message,
+            },
+        }
 
     def __call__(self, func):
         """This is called when the mapper is used as a decorator."""
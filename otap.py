@@ -14,14 +14,35 @@ from bottle import response, template, static_file, request
 import zipfile
 import owntracks
 from owntracks import cf
-from owntracks.dbschema import db, Otap, Versioncheck, Settings, Imeiset, createalltables, dbconn, fn, JOIN_LEFT_OUTER
+from owntracks.dbschema import db, Otap, Versioncheck, Notifyevent, Settings, Settingslayer, Imeiset, createalltables, dbconn, dbclose, poolstats, schemaversion, checkindexes, fn, Param, JOIN_LEFT_OUTER, OperationalError
+from owntracks import writebehind
+from owntracks.writebehind import WriteBehind, Coalescer, MAXPARAMS
+from owntracks.jarindex import JarIndex
+from owntracks.nonces import NonceCache, SharedNonceCache
+from owntracks.publisher import Publisher
+from owntracks.admission import DownloadSlots, SharedDownloadSlots
+from owntracks import rollout
+from owntracks.pollhint import RateMeter, PollHint
+from owntracks.retention import Retention
+from owntracks import retention as vlogrollup
+from owntracks.fleetstats import FleetCounters
+from owntracks.funnel import Funnel
+from owntracks.cache import LRUCache
+from owntracks.generation import Generation, SharedGeneration
+from owntracks.breaker import CircuitBreaker
+from owntracks.snapshot import Snapshot
+from owntracks import funnel as upgradefunnel
 import time
+import datetime
+import operator
+import re
 import hashlib
-from distutils.version import StrictVersion
 import warnings
 import base64
+import json
 import textwrap
-import paho.mqtt.publish as mqtt
+import collections
+import functools
 import pytz
 
 log = logging.getLogger(__name__)
@@ -34,24 +55,150 @@ with warnings.catch_warnings():
     import nacl.utils
     from nacl.encoding import Base64Encoder
 
+# Versioncheck log rows are written behind the request, in bulk
+vclog = WriteBehind(Versioncheck, batchsize=cf.vlogbatch, interval=cf.vlogdelay, maxqueue=cf.vlogqueue)
+
+# ... and so are the OTAP results devices notify
+notifylog = WriteBehind(Notifyevent, batchsize=cf.vlogbatch, interval=cf.vlogdelay, maxqueue=cf.vlogqueue)
+
+# Notifications are queued and published over a persistent MQTT connection
+publisher = Publisher(hostname=cf.notifyhost, port=cf.notifyport, maxqueue=cf.notifyqueue,
+                batchsize=cf.notifybatch, policy=cf.notifypolicy, spool=cf.notifyspool)
+
+# Versions, sizes and mtimes of the JARs in jardir
+jarindex = JarIndex(cf.jardir)
+
+# Old versioncheck log rows are rolled up into hourly and daily counts
+retention = Retention(raw=cf.vlograw, hourly=cf.vloghourly, daily=cf.vlogdaily,
+                chunk=cf.vlogchunk, interval=cf.vlogprune)
+
+# Otap rows read by the device-facing routes, for at most devcachettl
+# seconds. RPCs which change devices bump the generation, so that all
+# workers sharing it re-read them. What devices report only changes our own
+# copies; other workers see it when their entries expire.
+if cf.devcachestore is not None:
+    devgeneration = SharedGeneration(cf.devcachestore)
+else:
+    devgeneration = Generation()
+devices = LRUCache(maxsize=cf.devcache, generation=devgeneration, ttl=cf.devcachettl)
+
+def heartbeats_written(rows):
+    # heartbeat() patched our copies already; re-read these once anyway
+    devices.discard([imei for imei, values in rows.iteritems() if 'reported' in values])
+
+# lastcheck/reported updates on Otap are coalesced and applied periodically
+heartbeats = Coalescer(Otap, Otap.imei, interval=cf.hbinterval, onwrite=heartbeats_written)
+
+# Parsed settings per set name, and each IMEI's set and effective settings.
+# Changes bump the generation, which makes every cache sharing it start afresh.
+if cf.setcachestore is not None:
+    setgeneration = SharedGeneration(cf.setcachestore)
+else:
+    setgeneration = Generation()
+setcache = LRUCache(maxsize=cf.setcache, generation=setgeneration)
+effective = LRUCache(maxsize=cf.setcache, generation=setgeneration)
+
+# Per-customer device counts, kept up to date as devices change
+fleetcounters = FleetCounters(interval=cf.statsinterval, pending=heartbeats.pending,
+                latest=lambda: (list_jars() or [None])[-1], reconcile=cf.statsreconcile)
+rollout.counters = fleetcounters
+
+# Each device's way from upgrade=1 to its notify, for otc funnel
+funnel = Funnel(interval=cf.funneldelay, maxqueue=cf.funnelqueue)
+
+# At most dlslots devices are told to upgrade at the same time
+if cf.dlslotstore is not None:
+    downloads = SharedDownloadSlots(cf.dlslotstore, maxslots=cf.dlslots, ttl=cf.dlslotttl)
+else:
+    downloads = DownloadSlots(maxslots=cf.dlslots, ttl=cf.dlslotttl)
+
+# versionchecks per second seen by this process, and the versionInterval
+# we suggest to devices based on it
+vcrate = RateMeter(window=cf.pollwindow)
+pollhint = PollHint(vcrate, base=cf.pollbase, floor=cf.pollfloor, ceiling=cf.pollceiling,
+                target=cf.polltarget, jitter=cf.polljitter, step=cf.pollstep,
+                overrides=cf.config('pollhints'))
+
+SECRET_TEXT = b'OvEr.THe.aIR*'
+
+# The SecretBox is built once per process, on first use
+secretbox = None
+
+# Nonces of tokens already used, so that a token can't be replayed
+if cf.noncestore is not None:
+    nonces = SharedNonceCache(cf.noncestore, window=cf.noncewindow)
+else:
+    nonces = NonceCache(window=cf.noncewindow, maxsize=cf.noncemax)
+
+def mutates(method):
+    ''' Decorate the Methods which change Otap rows: the rows other workers
+        have in their `devices' cache are stale once the call is made '''
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        result = None
+        try:
+            result = method(*args, **kwargs)
+            return result
+        finally:
+            if result != "NOP":
+                devices.invalidate()
+
+    return wrapper
+
 def _keycheck(secret):
+    ''' Verify <secret> once per HTTP request: the calls of a JSON-RPC
+        batch all carry the same token, which is decrypted and checked
+        against the replay cache for the first call only. '''
+
+    if not isinstance(secret, basestring):
+        return False
+
+    try:
+        checked = request.environ.setdefault('otap.keycheck', {})
+    except RuntimeError:
+        # Not within a request
+        checked = {}
+
+    if secret not in checked:
+        checked[secret] = _verify(secret)
+
+    return checked[secret]
+
+def _verify(secret):
     ''' <secret> is a base64-encoded, encrypted payload. Decrypt and
-        verify content '''
+        verify content. The plaintext is SECRET_TEXT followed by "@" and the
+        client's UNIX time, which must be within noncewindow seconds of ours;
+        the token's nonce must not have been seen before. Tokens from older
+        otc versions carry just SECRET_TEXT and are accepted if otclegacy
+        is set. '''
+
+    global secretbox
 
     authorized = False
 
-    key = base64.b64decode(cf.otckey)
-    box = nacl.secret.SecretBox(key)
+    if secretbox is None:
+        key = base64.b64decode(cf.otckey)
+        secretbox = nacl.secret.SecretBox(key)
 
     try:
         encrypted = base64.b64decode(secret)
-        nonce = encrypted[0:24]
-        print base64.b64encode(nonce)
-        # FIXME: invalidate nonce
-
-        plaintext = box.decrypt(encrypted)
-        if plaintext == b'OvEr.THe.aIR*':
-            authorized = True
+        nonce = encrypted[0:nacl.secret.SecretBox.NONCE_SIZE]
+
+        plaintext = secretbox.decrypt(encrypted)
+        if plaintext.startswith(SECRET_TEXT + b'@'):
+            tstamp = int(plaintext[len(SECRET_TEXT) + 1:])
+            if abs(time.time() - tstamp) > cf.noncewindow:
+                log.error("Rejecting RPC token: timestamp is {0} seconds off".format(int(time.time() - tstamp)))
+                return False
+        elif plaintext != SECRET_TEXT or not cf.otclegacy:
+            return False
+
+        if nonces.seen(base64.b64encode(nonce)):
+            log.error("Rejecting RPC token: nonce has already been used or can't be recorded")
+            return False
+
+        authorized = True
     except Exception, e:
         log.error("Decryption says {0}".format(str(e)))
 
@@ -59,21 +206,62 @@ def _keycheck(secret):
     return authorized
 
 def list_jars():
-    ''' Obtain a list of JAR files, and return a sorted list of versions '''
-
-    versions = []
-    for f in os.listdir(cf.jardir):
-        if f.startswith('.'):
-            continue
-        path = os.path.join(cf.jardir, f)
-        if os.path.isfile(path):
-            versions.append(f.replace('.jar', ''))
+    ''' Obtain a list of JAR files, and return a sorted list of versions.
+        The directory is only rescanned when it has changed. '''
+
+    return jarindex.list()
+
+JAD = textwrap.dedent("""\
+    MIDlet-1: AppMain,,general.AppMain
+    MIDlet-Jar-Size: {octets}
+    MIDlet-Jar-URL: {jarURL}
+    MIDlet-Name: OwnTracks
+    MIDlet-Permissions: javax.microedition.io.Connector.http, javax.microedition.io.Connector.https, javax.microedition.io.Connector.ssl, javax.microedition.io.Connector.socket
+    MIDlet-Vendor: Choral
+    MIDlet-Version: {deliver}
+    MicroEdition-Configuration: CLDC-1.1
+    MicroEdition-Profile: IMP-NG
+    """)
+
+# version -> ((size, mtime, jarurl), JAD body)
+jadcache = {}
+
+def jad_descriptor(version):
+    ''' Return the JAD for JAR `version' or None if there is no such JAR.
+        The descriptor is rendered once and served from jadcache until the
+        JAR's size or mtime change. '''
+
+    jar = jarindex.get(version)
+    if jar is None:
+        jadcache.pop(version, None)
+        return None
+
+    # Stat the JAR itself rather than trusting the index: the size must be
+    # exact or devices reject the download
+    try:
+        st = os.stat(jar['path'])
+    except OSError:
+        jadcache.pop(version, None)
+        return None
+
+    stamp = (st.st_size, st.st_mtime, cf.jarurl)
+    cached = jadcache.get(version)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    params = {
+        'octets'    : st.st_size,
+        'jarURL'    : "%s/%s/OwnTracks.jar" % (cf.jarurl, version),
+        'deliver'   : version,
+    }
 
-    versions.sort(key=StrictVersion)
-    return versions
+    jad = JAD.format(**params)
+    jadcache[version] = (stamp, jad)
+    return jad
 
 def notify(top, message):
-    ''' Publish an MQTT notification to cf.notify + top '''
+    ''' Publish an MQTT notification to cf.notify + top. The message is
+        only queued here; the publisher's thread sends it. '''
 
     if cf.notify is None:
         return
@@ -81,12 +269,7 @@ def notify(top, message):
     topic = cf.notify + "/" + top
     payload = message
 
-    try:
-        mqtt.single(topic, payload, qos=1, retain=False, hostname='localhost',
-            port=1883)
-    except Exception, e:
-        log.error("Cannot MQTT publish: {0}".format(str(e)))
-        pass
+    publisher.put(topic, payload)
 
 def utc_to_localtime(dt, tzname='UTC'):
     ''' Convert datetime 'dt' which is in UTC to the timezone specified as 'tzname' '''
@@ -104,17 +287,57 @@ def utc_to_localtime(dt, tzname='UTC'):
     # log.debug("utc_time: TZ={0}: {1} => {2}".format(tzname, dt, new_s))
     return new_s
 
+def parse_settings(settings):
+    ''' Split a settings string "key=val;key=val" into a list of dicts.
+        Empty entries are ignored; raises ValueError for an entry which
+        isn't key=val. '''
+
+    slist = []
+    for kv in (settings or '').split(';'):
+        if not kv.strip():
+            continue
+        k, sep, v = kv.partition('=')
+        if not sep or not k.strip():
+            raise ValueError("malformed setting `{0}'; expecting key=value".format(kv))
+        slist.append(dict(key=k, val=v))
+
+    return slist
+
 def expand_settings(settings):
+    ''' Like parse_settings, for settings stored before they were checked:
+        malformed entries are logged and left out '''
+
     slist = []
-    try:
-        for kv in settings.split(';'):
-            k, v = kv.split('=')
-            slist.append(dict(key=k, val=v))
-    except:
-        pass
+    for kv in (settings or '').split(';'):
+        try:
+            slist.extend(parse_settings(kv))
+        except ValueError, e:
+            log.warning("Ignoring stored setting: {0}".format(str(e)))
 
     return slist
 
+def heartbeat(imei, **values):
+    ''' Queue updates of lastcheck, reported or sdigest of IMEI's Otap row
+        and make them in our cached copy of the row '''
+
+    heartbeats.put(imei, **values)
+    devices.update(imei, values)
+
+def settings_digest(settings):
+    ''' A digest of the settings list sent to a device, as kept in sdigest '''
+
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+def resend_settings(where):
+    ''' Forget the digest of the settings last sent to the devices matching
+        `where', so that their next versioncheck gets their settings again.
+        Returns the number of devices. '''
+
+    imeis = [o.imei for o in Otap.select(Otap.imei).where(where).naive()]
+    n = Otap.update(sdigest=None).where(where).execute()
+    heartbeats.discard('sdigest', imeis)
+    return n
+
 def imei_settings(imei):
     ''' Get a list of settings for this specific IMEI '''
 
@@ -137,27 +360,480 @@ def imei_settings(imei):
 
     return settings
 
-def imei_getflags(imei):
-    ''' Get the flags for IMEI and return as string or "" if no flags '''
+MISSING = object()
+
+def set_settings(sname, gen, stored=MISSING):
+    ''' Return the parsed settings of set `sname' (None if there is no such
+        set) from setcache or else from `stored', the string read along with
+        the device, or the database '''
+
+    if sname is None:
+        return None
+
+    settings = setcache.get(sname, MISSING)
+    if settings is MISSING:
+        if stored is MISSING:
+            try:
+                stored = Settings.get(Settings.sname == sname).settings
+            except Settings.DoesNotExist:
+                stored = None
+        settings = expand_settings(stored) if stored is not None else None
+        setcache.put(sname, settings, gen)
+
+    return settings
+
+# A device's effective settings are merged from these layers, each one
+# overriding the keys of those before it:
+#   global          Settingslayer scope 'global'
+#   custid:<custid> Settingslayer scope 'custid' for the device's customer
+#   set:<sname>     the set assigned to the device (Imeiset, Settings)
+#   imei            Settingslayer scope 'imei' for the device itself
+
+LAYERSCOPES = ('global', 'custid', 'imei')
+
+def effective_settings(custid, imei, sname, gen=None, stored=MISSING):
+    ''' Return the effective settings of device `imei' of `custid' with set
+        `sname' (`stored' is the set's string if it was read already) as a
+        list of dicts with key, val and the source layer of the value '''
+
+    layers = {}
+    query = Settingslayer.select().where(
+        (Settingslayer.scope == 'global') |
+        ((Settingslayer.scope == 'custid') & (Settingslayer.name == custid)) |
+        ((Settingslayer.scope == 'imei') & (Settingslayer.name == imei)))
+    for l in query.naive():
+        layers[l.scope] = expand_settings(l.settings)
+
+    return merge_settings(custid, sname, layers.get('global'), layers.get('custid'),
+        set_settings(sname, gen, stored), layers.get('imei'))
+
+def merge_settings(custid, sname, glob, cust, sset, own):
+    ''' Merge the settings lists of the four layers (None for a missing one) '''
+
+    merged = collections.OrderedDict()
+    for source, slist in (
+            ('global', glob),
+            ('custid:{0}'.format(custid), cust),
+            ('set:{0}'.format(sname), sset),
+            ('imei', own)):
+        for kv in slist or []:
+            merged[kv['key']] = dict(key=kv['key'], val=kv['val'], source=source)
+
+    return merged.values()
+
+DEVICECOLUMNS = ('imei', 'custid', 'tid', 'reported', 'deliver', 'block', 'lastcheck', 'flags', 'sdigest')
+
+def device_row(q):
+    return dict((c, getattr(q, c)) for c in DEVICECOLUMNS)
+
+def imei_state(imei):
+    ''' Resolve everything the device-facing routes need to know about IMEI:
+        the Otap row (including its flags), the name of the settings set
+        assigned to it, whether that set is once-only, and its effective
+        settings as a list. The row is kept in `devices' and, unless the
+        device has a once-only set, the latter three in `effective'. What
+        they don't hold is read in a single query, the settings merged with
+        the other layers. Returns a dict, with `cached' True if nothing was
+        read, or None if the IMEI is not in the database. '''
+
+    imei = imei.strip()
+
+    gen = setcache.current()
+    devgen = devices.current()
+    cached = effective.get(imei, MISSING)
+    row = devices.get(imei, MISSING)
+    fromcache = cached is not MISSING and row is not MISSING
+
+    if cached is MISSING:
+        query = (Otap
+            .select(Otap, Imeiset.sname, Imeiset.once, Settings.settings)
+            .join(Imeiset, JOIN_LEFT_OUTER, on=(Otap.imei == Imeiset.imei))
+            .join(Settings, JOIN_LEFT_OUTER, on=(Imeiset.sname == Settings.sname))
+            .where(Otap.imei == imei)
+            )
+
+        try:
+            q = query.naive().get()
+        except Otap.DoesNotExist:
+            return None
+
+        row = device_row(q)
+        devices.put(imei, row, devgen)
+
+        sname, once = q.sname, q.once or 0
+        settings = [dict(key=kv['key'], val=kv['val']) for kv in effective_settings(q.custid, q.imei, sname, gen, q.settings)]
+        if once == 0:
+            # Once-only sets are deleted when delivered, so every worker
+            # has to see that in the database
+            effective.put(imei, (sname, once, settings), gen)
+    else:
+        if row is MISSING:
+            try:
+                row = device_row(Otap.select().where(Otap.imei == imei).naive().get())
+            except Otap.DoesNotExist:
+                return None
+            devices.put(imei, row, devgen)
+
+        sname, once, settings = cached
+
+    hb = heartbeats.pending(imei)
+
+    state = {
+        'imei'      : row['imei'],
+        'custid'    : row['custid'],
+        'tid'       : row['tid'],
+        'reported'  : hb.get('reported', row['reported']),
+        'deliver'   : row['deliver'],
+        'block'     : row['block'],
+        'lastcheck' : hb.get('lastcheck', row['lastcheck']),
+        'flags'     : row['flags'] or "",
+        'sname'     : sname,
+        'once'      : once,
+        'settings'  : settings,
+        'sdigest'   : hb.get('sdigest', row['sdigest']),
+        'cached'    : fromcache,
+    }
+
+    log.debug("Flagstring for {0} is {1}".format(imei, state['flags']))
+    return state
+
+def snapshot_devices():
+    ''' Return the state of every device as imei_state() does (lastcheck
+        as a string), by IMEI, for the snapshot '''
+
+    layers = dict((scope, {}) for scope in LAYERSCOPES)
+    for l in Settingslayer.select().naive():
+        layers[l.scope][l.name] = expand_settings(l.settings)
+    sets = dict((s.sname, expand_settings(s.settings)) for s in Settings.select().naive())
+
+    states = {}
+    query = (Otap
+        .select(Otap, Imeiset.sname, Imeiset.once)
+        .join(Imeiset, JOIN_LEFT_OUTER, on=(Otap.imei == Imeiset.imei))
+        )
+    for q in query.naive().iterator():
+        hb = heartbeats.pending(q.imei)
+        settings = merge_settings(q.custid, q.sname, layers['global'].get(''), layers['custid'].get(q.custid),
+            sets.get(q.sname), layers['imei'].get(q.imei))
+
+        states[q.imei] = {
+            'imei'      : q.imei,
+            'custid'    : q.custid,
+            'tid'       : q.tid,
+            'reported'  : hb.get('reported', q.reported),
+            'deliver'   : q.deliver,
+            'block'     : q.block,
+            'lastcheck' : str(hb.get('lastcheck', q.lastcheck) or '') or None,
+            'flags'     : q.flags or "",
+            'sname'     : q.sname,
+            'once'      : q.once or 0,
+            'settings'  : [dict(key=kv['key'], val=kv['val']) for kv in settings],
+            'sdigest'   : hb.get('sdigest', q.sdigest),
+        }
+
+    return states
+
+def rollout_changed(message):
+    if message is None:
+        return
+    # The next wave may have been released
+    devices.invalidate()
+    log.info(message)
+    notify('rollout', message)
+
+# OTAP results notified while we answered from the snapshot
+rolloutresults = rollout.Results(onchange=rollout_changed, batchsize=cf.vlogbatch,
+                interval=cf.vlogdelay, maxqueue=cf.vlogqueue)
+
+def database_back():
+    rolloutresults.wakeup.set()
+
+# After dbfailures failed (or slower than dbslow seconds) device lookups in
+# a row, the device-facing routes answer from the snapshot for dbcooldown
+# seconds before trying the database again
+breaker = CircuitBreaker(failures=cf.dbfailures, cooldown=cf.dbcooldown, slow=cf.dbslow,
+                onclose=database_back)
+snapshot = Snapshot(snapshot_devices, path=cf.snapshotfile, interval=cf.snapshotinterval)
+
+def device_state(imei):
+    ''' Return imei_state(IMEI) and False or, while the circuit breaker
+        keeps us off the database, IMEI's state in the snapshot, updated with
+        what is queued for its row, and True '''
+
+    if snapshot.enabled():
+        snapshot.start()
+
+    if breaker.allow():
+        started = time.time()
+        try:
+            if not dbconn():
+                raise OperationalError("cannot connect")
+            if breaker.tripped():
+                # The trial must reach the database, not just our caches
+                db.execute_sql("SELECT 1")
+                queried = True
+            else:
+                queried = False
+            state = imei_state(imei)
+        except Exception, e:
+            breaker.failure()
+            log.error("Cannot get OTAP record for {0} from DB: {1}; using snapshot".format(imei, str(e)))
+        else:
+            # A lookup served from the caches tells us nothing about the
+            # database
+            if queried or state is None or not state['cached']:
+                breaker.success(time.time() - started)
+            return state, False
+
+    state = snapshot.get(imei.strip())
+    if state is not None:
+        # What the device reported and was sent since the snapshot was
+        # taken is queued for the database; without sdigest, every poll
+        # would get its settings again
+        state.update(heartbeats.pending(imei.strip()))
+    return state, True
+
+def fleetstate(o):
+    ''' The state of Otap row `o' as FleetCounters counts it '''
+
+    hb = heartbeats.pending(o.imei)
+    return {
+        'custid'    : o.custid,
+        'reported'  : hb.get('reported', o.reported),
+        'deliver'   : o.deliver,
+        'block'     : o.block,
+        'lastcheck' : hb.get('lastcheck', o.lastcheck),
+    }
 
-    dbconn()
+def device_rows(otaps):
+    ''' Turn Otap rows into the dicts show and find return, with the name
+        of the settings set assigned to each device. Only the Imeiset rows
+        of these devices are read. '''
 
-    flagstring = ""
+    otaps = list(otaps)
+    imeis = [q.imei for q in otaps]
 
+    snames = {}
+    for n in range(0, len(imeis), MAXPARAMS):
+        query = Imeiset.select().where(Imeiset.imei << imeis[n:n + MAXPARAMS])
+        for q in query.naive():
+            snames[q.imei] = q.sname
+
+    results = []
+    for q in otaps:
+        hb = heartbeats.pending(q.imei)
+        results.append({
+            'imei'      : q.imei,
+            'custid'    : q.custid,
+            'tid'       : q.tid,
+            'block'     : q.block,
+            'reported'  : hb.get('reported', q.reported),
+            'deliver'   : q.deliver,
+            'sname'     : snames.get(q.imei, ""),
+            'lastcheck' : utc_to_localtime(hb.get('lastcheck', q.lastcheck)),
+            'comment'   : q.comment or '',
+            'flags'     : q.flags or '',
+            })
+
+    return results
+
+# Paginated results are read by keyset: a page starts after the last key of
+# the previous one, so reading page n doesn't cost reading pages 1..n-1. The
+# key is handed to the client as an opaque cursor token.
+
+def make_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+def read_cursor(cursor):
+    if not cursor:
+        return None
     try:
-        imei = imei.strip()
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def page_limit(limit):
+    return max(1, min(int(limit or cf.pagesize), cf.pagemax))
+
+def page_devices(cursor=None, limit=None, word=None):
+    ''' Return a page of devices ordered by IMEI, optionally only those
+        whose TID or custid is `word', and the cursor of the next page
+        (None after the last page). '''
+
+    limit = page_limit(limit)
+    after = read_cursor(cursor)
+
+    query = Otap.select()
+    if word is not None:
+        query = query.where((Otap.tid == word) | (Otap.custid == word))
+    if after is not None:
+        query = query.where(Otap.imei > after)
+    query = query.order_by(Otap.imei.asc()).limit(limit + 1)
+
+    otaps = list(query.naive())
+    more = len(otaps) > limit
+    otaps = otaps[:limit]
+
+    nextcursor = make_cursor(otaps[-1].imei) if more else None
+    return device_rows(otaps), nextcursor
+
+def page_versionlog(cursor=None, limit=None):
+    ''' Return a page of versioncheck log entries, newest first, and the
+        cursor of the next page (None after the last page). Rows still
+        queued for writing are flushed when the first page is read so that
+        paging through the table sees them. '''
+
+    limit = page_limit(limit)
+    before = read_cursor(cursor)
+
+    if before is None:
+        vclog.flush()
+        dbconn()
 
-        o = Otap.get(Otap.imei == imei)
-        flagstring = o.flags or ""
+    query = Versioncheck.select()
+    if before is not None:
+        query = query.where(Versioncheck.id < before)
+    query = query.order_by(Versioncheck.id.desc()).limit(limit + 1)
 
-    except Otap.DoesNotExist:
-        flagstring = ""
-    except Exception, e:
-        log.error("Cannot imei_getflags({0}): {1}".format(imei, str(e)))
-        pass
+    rows = list(query.naive())
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    logs = []
+    for q in rows:
+        logs.append({
+            'imei'      : q.imei,
+            'version'   : q.version,
+            'tstamp'    : utc_to_localtime(q.tstamp),
+            'upgrade'   : q.upgrade,
+            })
+
+    nextcursor = make_cursor(rows[-1].id) if more else None
+    return logs, nextcursor
+
+def parse_time(s):
+    ''' Parse a UTC time given as YYYY-MM-DD[ HH:MM[:SS]]; raises ValueError '''
+
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(s.strip(), fmt)
+        except ValueError:
+            pass
+    raise ValueError("invalid time {0}; use YYYY-MM-DD[ HH:MM[:SS]]".format(s))
+
+def page_notifylog(cursor=None, limit=None, imei=None, custid=None, version=None,
+            since=None, until=None, failed=False):
+    ''' Return a page of notified OTAP results matching the given IMEI,
+        custid, version, time range [since, until) and/or only failures,
+        newest first, and the cursor of the next page. As for the
+        versioncheck log, queued rows are flushed for the first page. '''
+
+    limit = page_limit(limit)
+    before = read_cursor(cursor)
+
+    if before is None:
+        notifylog.flush()
+        dbconn()
+
+    query = Notifyevent.select()
+    if imei is not None:
+        query = query.where(Notifyevent.imei == imei.replace(' ', ''))
+    if custid is not None:
+        query = query.where(Notifyevent.custid == custid)
+    if version is not None:
+        query = query.where(Notifyevent.version == version)
+    if since is not None:
+        query = query.where(Notifyevent.tstamp >= parse_time(since))
+    if until is not None:
+        query = query.where(Notifyevent.tstamp < parse_time(until))
+    if failed:
+        query = query.where(Notifyevent.ok == 0)
+    if before is not None:
+        query = query.where(Notifyevent.id < before)
+    query = query.order_by(Notifyevent.id.desc()).limit(limit + 1)
+
+    rows = list(query.naive())
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    events = []
+    for q in rows:
+        events.append({
+            'imei'      : q.imei,
+            'custid'    : q.custid,
+            'tid'       : q.tid,
+            'device'    : q.device,
+            'version'   : q.version,
+            'result'    : q.result,
+            'ok'        : q.ok,
+            'tstamp'    : utc_to_localtime(q.tstamp),
+            })
+
+    nextcursor = make_cursor(rows[-1].id) if more else None
+    return events, nextcursor
+
+def resolve_version(version):
+    ''' Turn the version given to deliver into what we store: "ANY" is a
+        synonym for "*", and "latest" is the highest version installed now.
+        Returns None if there is no JAR for the version. '''
+
+    version = version.replace(' ', '')
+
+    if version == 'ANY':
+        version = '*'
+
+    if version == 'latest':
+        # Get sorted versions and take highest
+        jars = list_jars()
+        if not jars:
+            return None
+        version = jars[-1]
+
+    if version != '*':
+        if jarindex.get(version) is None:
+            return None
+
+    return version
 
-    log.debug("Flagstring for {0} is {1}".format(imei, flagstring))
-    return flagstring
+def version_missing():
+    ''' What to answer when resolve_version() found nothing '''
+
+    return "No such version here" if list_jars() else "No JARs available"
+
+def fleet_where(selector):
+    ''' Build the WHERE clause on Otap for a fleet selector, a dict with
+        any of
+            custid      devices of this customer
+            tid         list of TIDs
+            reported    devices which last reported this version
+            flags       devices whose flags contain this string
+            imei        list of IMEIs (e.g. read from a file by otc)
+            all         True to select every device
+        Conditions are ANDed. Returns None for an empty selector so that
+        a forgotten option doesn't change the whole fleet. '''
+
+    clauses = []
+    if selector.get('custid'):
+        clauses.append(Otap.custid == selector['custid'])
+    if selector.get('tid'):
+        clauses.append(Otap.tid << list(selector['tid']))
+    if selector.get('reported'):
+        clauses.append(Otap.reported == selector['reported'])
+    if selector.get('flags'):
+        clauses.append(Otap.flags.contains(selector['flags']))
+    if selector.get('imei'):
+        clauses.append(Otap.imei << [i.replace(' ', '') for i in selector['imei']])
+
+    if not clauses:
+        if selector.get('all'):
+            return (Otap.imei == Otap.imei)
+        return None
+
+    return reduce(operator.and_, clauses)
+
+@bottle.hook('after_request')
+def db_return():
+    dbclose()
 
 @bottle.route('/')
 def index():
@@ -188,6 +864,7 @@ class Methods(object):
         return list_jars()
 
 
+    @mutates
     def add_imei(self, otckey, imei, custid, tid):
         ''' Add to database. If IMEI exists, other fields are updated. '''
 
@@ -202,11 +879,16 @@ class Methods(object):
 
         try:
             o = Otap.get(Otap.imei == imei)
+            old = fleetstate(o)
 
             o.custid  = custid
             o.tid     = tid
             o.block   = 0
             o.save()
+            fleetcounters.move(old, fleetstate(o))
+            if old['custid'] != custid:
+                # Its customer's settings apply now
+                setcache.invalidate()
         except Otap.DoesNotExist:
             item = {
                 'imei'   : imei,
@@ -217,6 +899,7 @@ class Methods(object):
             try:
                 o = Otap(**item)
                 o.save()
+                fleetcounters.move(None, fleetstate(o))
 
                 log.info("Stored OTAP IMEI {0} in database".format(imei))
             except Exception, e:
@@ -228,6 +911,7 @@ class Methods(object):
         notify('add_imei', message)
         return message
 
+    @mutates
     def deliver(self, otckey, imei, version):
         ''' Update IMEI in database and set version to be delivered.
             n.nn.nn means that version, "latest" means current highest version,
@@ -240,30 +924,23 @@ class Methods(object):
         dbconn()
 
         imei = imei.replace(' ', '')
-        version = version.replace(' ', '')
-
-        if version == 'ANY':
-            version = '*'
-
-        if version == 'latest':
-            # Get sorted versions and take highest
-            version = list_jars()[-1]
 
-        if version != '*':
-            jarfile = "{0}/{1}.jar".format(cf.jardir, version)
-            if not os.path.isfile(jarfile):
-                return "No such version here"
+        version = resolve_version(version)
+        if version is None:
+            return version_missing()
 
         custid = ""
         tid    = ""
         try:
             o = Otap.get(Otap.imei == imei)
+            old = fleetstate(o)
             o.deliver = version
 
             custid = o.custid or ""
             tid    = o.tid or ""
 
             o.save()
+            fleetcounters.move(old, fleetstate(o))
         except:
             return "Can't find IMEI {0} in DB".format(imei)
 
@@ -294,7 +971,7 @@ class Methods(object):
             return "Cannot purge this version: {0} clients are expecting it".format(n)
 
         jarfile = "{0}/{1}.jar".format(cf.jardir, version)
-        if not os.path.isfile(jarfile):
+        if jarindex.get(version) is None:
             return "No such version here"
 
         try:
@@ -303,12 +980,16 @@ class Methods(object):
             s = "Error removing {0}: {1}".format(jarfile, str(e))
             log.error(s)
             return s
+        finally:
+            jarindex.invalidate()
+            jadcache.pop(version, None)
 
         message = "{0} removed".format(jarfile)
         notify('purge', message)
         return message
 
 
+    @mutates
     def block(self, otckey, imei, bl):
         ''' Set block in db for IMEI. If IMEI == 'ALL', then for all '''
 
@@ -320,10 +1001,22 @@ class Methods(object):
         imei = imei.replace(' ', '')
         nrecs = None
         try:
+            old = None
+            if imei != 'ALL':
+                try:
+                    old = fleetstate(Otap.get(Otap.imei == imei))
+                except Otap.DoesNotExist:
+                    pass
+            else:
+                fleetcounters.change(None, block=bl)
+
             query = Otap.update(block = bl)
             if imei != 'ALL':
                 query = query.where(Otap.imei == imei)
             nrecs = query.execute()
+
+            if old is not None:
+                fleetcounters.move(old, dict(old, block=bl))
         except Exception, e:
             s = "Cannot update db: {0}".format(str(e))
             log.error(s)
@@ -333,6 +1026,166 @@ class Methods(object):
         notify('blocker', message)
         return message
 
+    @mutates
+    def fleet(self, otckey, action, selector, arg=None, dryrun=0, once=0):
+        ''' Change all devices matching `selector' (see fleet_where) with
+            one set-based statement. `action' is one of count, deliver
+            (arg: version), block, unblock, setflags (arg: flagstring),
+            set (arg: settings name; once), unset, or resend (settings
+            at the next versioncheck). With dryrun, only report how many
+            devices would be affected. '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        where = fleet_where(selector or {})
+        if where is None:
+            return "Refusing to work on an empty selector; use all to select every device"
+
+        n = Otap.select().where(where).count()
+        if action == 'count' or dryrun:
+            return "{0} devices match".format(n)
+
+        # The otap columns which fleet counters follow, if changed
+        changes = None
+
+        if action == 'deliver':
+            version = resolve_version(arg or '')
+            if version is None:
+                return version_missing()
+            query = Otap.update(deliver=version).where(where)
+            changes = dict(deliver=version)
+            what = "will get {0} at next OTAP".format(version)
+
+        elif action in ('block', 'unblock'):
+            bl = 1 if action == 'block' else 0
+            query = Otap.update(block=bl).where(where)
+            changes = dict(block=bl)
+            what = "set to block={0}".format(bl)
+
+        elif action == 'setflags':
+            flagstring = (arg or '').strip() or None
+            query = Otap.update(flags=flagstring).where(where)
+            what = "have flags {0}".format(flagstring)
+
+        elif action == 'set':
+            sname = (arg or '').replace(' ', '')
+            if Settings.select().where(Settings.sname == sname).count() == 0:
+                return "Cannot assign setting {0}: it does not exist".format(sname)
+
+            query = None
+            what = "configured with setting {0}. Once={1}".format(sname, once)
+
+        elif action == 'unset':
+            query = Imeiset.delete().where(Imeiset.imei << Otap.select(Otap.imei).where(where))
+            what = "have no settings assigned"
+
+        elif action == 'resend':
+            query = None
+            what = "get their settings at the next versioncheck"
+
+        else:
+            return "Unknown fleet action {0}".format(action)
+
+        try:
+            if action == 'set':
+                # Imeiset allows one set per IMEI: replace existing assignments
+                with db.transaction():
+                    Imeiset.delete().where(Imeiset.imei << Otap.select(Otap.imei).where(where)).execute()
+                    selected = Otap.select(Otap.imei, Param(sname), Param(once)).where(where)
+                    Imeiset.insert_from([Imeiset.imei, Imeiset.sname, Imeiset.once], selected).execute()
+                    resend_settings(where)
+            elif action == 'resend':
+                n = resend_settings(where)
+            if query is not None:
+                if changes is not None:
+                    fleetcounters.change(where, **changes)
+                n = query.execute()
+            if action in ('set', 'unset'):
+                setcache.invalidate()
+        except Exception, e:
+            s = "Cannot update db: {0}".format(str(e))
+            log.error(s)
+            return s
+
+        message = "{0} devices {1}".format(n, what)
+        log.info(message)
+        notify('fleet', message)
+        return message
+
+    @mutates
+    def rollout_start(self, otckey, version, selector, wavesize=0, percent=0, advance=90):
+        ''' Roll `version' out to the devices matching `selector' (see
+            fleet_where) in waves of `wavesize' devices or `percent' percent
+            of them. The first wave is released now, each following one when
+            `advance' percent of the devices released so far have notified
+            a successful upgrade. '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        where = fleet_where(selector or {})
+        if where is None:
+            return "Refusing to work on an empty selector; use all to select every device"
+
+        version = resolve_version(version)
+        if version is None:
+            return version_missing()
+        if version == '*':
+            return "No such version here"
+
+        if not (wavesize or percent) or not 0 < advance <= 100:
+            return "A rollout needs a wave size or percentage and 0 < advance <= 100"
+
+        try:
+            r = rollout.start(version, where, selector, int(wavesize or 0), int(percent or 0), int(advance))
+        except Exception, e:
+            s = "Cannot start rollout: {0}".format(str(e))
+            log.error(s)
+            return s
+
+        if r is None:
+            return "No devices to roll {0} out to".format(version)
+
+        message = "Rollout {0} of {1} to {2} devices in {3} waves of {4} started".format(r.id, version, r.devices, r.waves, r.wavesize)
+        log.info(message)
+        notify('rollout', message)
+        return message
+
+    def rollout_status(self, otckey):
+        ''' Return the progress of all rollouts '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        return rollout.status()
+
+    @mutates
+    def rollout_ctl(self, otckey, rid, action):
+        ''' pause, resume, advance or abort rollout `rid' '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        try:
+            message = rollout.control(int(rid), action)
+        except Exception, e:
+            s = "Cannot {0} rollout {1}: {2}".format(action, rid, str(e))
+            log.error(s)
+            return s
+
+        log.info(message)
+        notify('rollout', message)
+        return message
+
     def show(self, otckey, imei):
         ''' Show content of database. If IMEI specified, then just that one. '''
 
@@ -341,8 +1194,6 @@ class Methods(object):
 
         dbconn()
 
-        results = []
-
 # This join works in dev but not in prod; same Peewee versions (!?!)
 #        query = (Otap
 ##            .select(Otap, Settings.sname.alias('sname'))
@@ -350,31 +1201,29 @@ class Methods(object):
 #            .join(Imeiset, JOIN_LEFT_OUTER, on=(Otap.imei == Imeiset.imei))
 #            )
 
-        # Lousy, but no other way at the moment ...
-        snames = {}
-        query = Imeiset.select()
-        for q in query.naive():
-            snames[q.imei] = q.sname
-
         query = Otap.select()
         if imei is not None:
             query = query.where(Otap.imei == imei)
         query = query.order_by(Otap.tid.asc())
-        for q in query.naive():
-            results.append({
-                'imei'      : q.imei,
-                'custid'    : q.custid,
-                'tid'       : q.tid,
-                'block'     : q.block,
-                'reported'  : q.reported,
-                'deliver'   : q.deliver,
-                'sname'     : snames.get(q.imei, ""),
-                'lastcheck' : utc_to_localtime(q.lastcheck),
-                'comment'   : q.comment or '',
-                'flags'     : q.flags or '',
-                })
 
-        return results
+        return device_rows(query.naive())
+
+    def show_page(self, otckey, cursor=None, limit=None, word=None):
+        ''' Like show (or find, with `word'), one page of at most `limit'
+            devices at a time. Returns a dict with the devices in `rows'
+            and in `cursor' the token for the next page, or None. '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        try:
+            rows, nextcursor = page_devices(cursor, limit, word)
+        except ValueError, e:
+            return str(e)
+
+        return { 'rows' : rows, 'cursor' : nextcursor }
 
     def find(self, otckey, word):
         ''' Find a word (tid or custid) in the database and show info. '''
@@ -384,31 +1233,14 @@ class Methods(object):
 
         if _keycheck(otckey) == True:
 
-            # Lousy, but no other way at the moment ... See comment re JOIN above
-            snames = {}
-            query = Imeiset.select()
-            for q in query.naive():
-                snames[q.imei] = q.sname
-
             query = Otap.select()
             query = query.where((Otap.tid == word) | (Otap.custid == word))
             query = query.order_by(Otap.tid.asc())
-            for q in query.naive():
-                results.append({
-                    'imei'      : q.imei,
-                    'custid'    : q.custid,
-                    'tid'       : q.tid,
-                    'block'     : q.block,
-                    'reported'  : q.reported,
-                    'deliver'   : q.deliver,
-                    'sname'     : snames.get(q.imei, ""),
-                    'lastcheck' : utc_to_localtime(q.lastcheck),
-                    'comment'   : q.comment or '',
-                    'flags'     : q.flags or '',
-                    })
+            results = device_rows(query.naive())
 
         return results
 
+    @mutates
     def setcomment(self, otckey, imei, text):
         ''' set a plain text comment for IMEI '''
 
@@ -438,6 +1270,7 @@ class Methods(object):
         notify("setcomment", res)
         return res
 
+    @mutates
     def setflags(self, otckey, imei, flagstring):
         ''' set flags on IMEI '''
 
@@ -524,18 +1357,198 @@ class Methods(object):
         logs = []
         if _keycheck(otckey) == True:
 
-            query = (Versioncheck.select().limit(count))
-            query = query.order_by(Versioncheck.tstamp.desc())
-            for q in query.naive():
+            # Rows still queued for writing are the most recent ones
+            pending = vclog.pending()[-count:] if count > 0 else []
+            for q in reversed(pending):
                 logs.append({
-                    'imei'      : q.imei,
-                    'version'   : q.version,
-                    'tstamp'    : utc_to_localtime(q.tstamp),
-                    'upgrade'   : q.upgrade,
+                    'imei'      : q['imei'],
+                    'version'   : q['version'],
+                    'tstamp'    : utc_to_localtime(datetime.datetime.strptime(q['tstamp'], '%Y-%m-%d %H:%M:%S')),
+                    'upgrade'   : q['upgrade'],
                     })
 
+            if len(logs) < count:
+                query = (Versioncheck.select().limit(count - len(logs)))
+                query = query.order_by(Versioncheck.tstamp.desc())
+                for q in query.naive():
+                    logs.append({
+                        'imei'      : q.imei,
+                        'version'   : q.version,
+                        'tstamp'    : utc_to_localtime(q.tstamp),
+                        'upgrade'   : q.upgrade,
+                        })
+
         return logs
 
+    def versionlog_page(self, otckey, cursor=None, limit=None):
+        ''' Page through the versioncheck log, newest first. Returns a dict
+            with the entries in `rows' and the next page's token in `cursor' '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        try:
+            rows, nextcursor = page_versionlog(cursor, limit)
+        except ValueError, e:
+            return str(e)
+
+        return { 'rows' : rows, 'cursor' : nextcursor }
+
+    def notifylog_page(self, otckey, cursor=None, limit=None, imei=None, custid=None,
+                version=None, since=None, until=None, failed=0):
+        ''' Page through the OTAP results notified by devices, newest first,
+            optionally only those of `imei', `custid', `version', from
+            `since' and before `until' (UTC), or only `failed' ones '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        try:
+            rows, nextcursor = page_notifylog(cursor, limit, imei, custid, version, since, until, failed)
+        except ValueError, e:
+            return str(e)
+
+        return { 'rows' : rows, 'cursor' : nextcursor }
+
+    def fleetstats(self, otckey, custid=None, rebuild=0):
+        ''' Return per custid the number of devices, blocked devices and
+            devices with a pending delivery, the distribution of reported
+            versions, and how many devices have been silent for 1h/24h/7d
+            or never checked in. With `rebuild', recount from scratch. '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        if rebuild:
+            fleetcounters.rebuild()
+        else:
+            fleetcounters.seed()
+
+        return fleetcounters.read(custid)
+
+    def versionstats(self, otckey, imei=None, custid=None, days=30):
+        ''' Return the number of versionchecks per version and upgrade in
+            the last `days' days, from the log and its rollups '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=int(days))
+        return vlogrollup.counts(imei, custid, since)
+
+    def versionhistory(self, otckey, imei, days=30):
+        ''' Return the versionchecks of `imei' in the last `days' days: the
+            log's own rows and, for older periods, hourly or daily counts '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=int(days))
+        history = vlogrollup.history(imei.replace(' ', ''), None, since)
+        for h in history:
+            h['period'] = utc_to_localtime(h['period'])
+        return history
+
+    def retention(self, otckey):
+        ''' Roll up and prune the versioncheck log now '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        if not retention.enabled():
+            return "No retention configured (vlograw, vloghourly, vlogdaily)"
+
+        return retention.flush()
+
+    def funnel(self, otckey, version=None, custid=None, days=30):
+        ''' Return per version how many upgrades offered in the last `days'
+            days reached each stage (JAD, JAR, notify), the conversion
+            between stages, JAR bytes sent and the time from offer to a
+            successful upgrade (50th/90th/99th percentile, in seconds) '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        funnel.flush()
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=int(days))
+        return upgradefunnel.report(version, custid, since)
+
+    def serverstats(self, otckey):
+        ''' Return counters of the server's internal queues and caches '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        stats = {
+            'versionlog'    : vclog.stats(),
+            'notifylog'     : notifylog.stats(),
+            'setcache'      : setcache.stats(),
+            'effective'     : effective.stats(),
+            'devices'       : devices.stats(),
+            'heartbeats'    : heartbeats.stats(),
+            'jars'          : jarindex.stats(),
+            'nonces'        : nonces.stats(),
+            'mqtt'          : publisher.stats(),
+            'dbpool'        : poolstats(),
+            'downloads'     : downloads.stats(),
+            'pollhint'      : pollhint.stats(),
+            'retention'     : retention.stats(),
+            'fleetstats'    : fleetcounters.stats(),
+            'funnel'        : funnel.stats(),
+            'breaker'       : breaker.stats(),
+            'snapshot'      : snapshot.stats(),
+            'rolloutresults': rolloutresults.stats(),
+        }
+
+        return stats
+
+    def dbcheck(self, otckey):
+        ''' Return the schema version and, for each of the queries the
+            server runs often, whether the database's plan uses an index '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        word = 'X1'
+        imei = '000000000000000'
+        queries = {
+            'find'          : Otap.select().where((Otap.tid == word) | (Otap.custid == word)),
+            'imei'          : Otap.select(Otap.imei).where((Otap.tid == word) & (Otap.custid == word)),
+            'purge'         : Otap.select(fn.COUNT(Otap.imei)).where(Otap.deliver == word),
+            'imei_state'    : (Otap
+                                .select(Otap, Imeiset.sname, Imeiset.once, Settings.settings)
+                                .join(Imeiset, JOIN_LEFT_OUTER, on=(Otap.imei == Imeiset.imei))
+                                .join(Settings, JOIN_LEFT_OUTER, on=(Imeiset.sname == Settings.sname))
+                                .where(Otap.imei == imei)),
+            'imei_settings' : (Settings
+                                .select(Settings)
+                                .join(Imeiset, JOIN_LEFT_OUTER, on=(Settings.sname == Imeiset.sname))
+                                .where(Imeiset.imei == imei)),
+            's_undef'       : Imeiset.select(fn.COUNT(Imeiset.imei)).where(Imeiset.sname == word),
+            'layers'        : Settingslayer.select().where((Settingslayer.scope == 'custid') & (Settingslayer.name == word)),
+            'device_log'    : Versioncheck.select().where(Versioncheck.imei == imei).order_by(Versioncheck.tstamp.desc()),
+            'notify_log'    : Notifyevent.select().where((Notifyevent.custid == word) & (Notifyevent.tstamp >= datetime.datetime(2000, 1, 1))),
+        }
+
+        return {
+            'schemaversion' : schemaversion(),
+            'queries'       : checkindexes(queries),
+        }
+
     def showsets(self, otckey, imei=None):
         ''' Return an array of settings entries. If IMEI then print those '''
 
@@ -569,11 +1582,19 @@ class Methods(object):
         sname = sname.replace(' ', '')
         message = "OK"
 
+        try:
+            parse_settings(settings)
+        except ValueError, e:
+            message = "Cannot define settings {0}: {1}".format(sname, str(e))
+            log.info(message)
+            return message
+
         try:
             s = Settings.get(Settings.sname == sname)
 
             s.settings  = settings
             s.save()
+            setcache.invalidate()
             message = "Updated settings {0} in database".format(sname)
             log.info(message)
         except Settings.DoesNotExist:
@@ -584,6 +1605,7 @@ class Methods(object):
             try:
                 s = Settings(**item)
                 s.save()
+                setcache.invalidate()
 
                 message = "Stored Settings {0} in database".format(sname)
                 log.info(message)
@@ -621,6 +1643,7 @@ class Methods(object):
             try:
                 query = Settings.delete().where(Settings.sname == sname)
                 nrows = query.execute()
+                setcache.invalidate()
                 message = "Delete {0} from settings: {1} row deleted".format(sname, nrows)
                 log.info(message)
             except Exception, e:
@@ -633,6 +1656,7 @@ class Methods(object):
         notify('s_undef', message)
         return message
 
+    @mutates
     def s_set(self, otckey, imei, sname, bf, once):
         ''' Set/unset settings SNAME on IMEI '''
 
@@ -648,6 +1672,7 @@ class Methods(object):
             # Unset
             query = Imeiset.delete().where(Imeiset.imei == imei , Imeiset.sname == sname)
             nrows = query.execute()
+            setcache.invalidate()
 
             message = "{0} row deleted from IMEIset for {1}/{2}".format(nrows, imei, sname)
             log.info(message)
@@ -668,6 +1693,8 @@ class Methods(object):
             try:
                 i = Imeiset(**item)
                 i.save()
+                setcache.invalidate()
+                resend_settings(Otap.imei == imei)
 
                 message = "Setting {0} configured for {1}. Once={2}".format(sname, imei, once)
             except Exception, e:
@@ -689,6 +1716,117 @@ class Methods(object):
         return message
 
 
+    def s_layer(self, otckey, scope, name=None, settings=None):
+        ''' Define the settings of layer `scope' (global, custid or imei)
+            for `name' (the custid or IMEI), or remove it if `settings' is
+            None '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        if scope not in LAYERSCOPES:
+            return "Unknown settings layer {0}; use one of {1}".format(scope, ", ".join(LAYERSCOPES))
+
+        name = '' if scope == 'global' else (name or '').replace(' ', '')
+        if scope != 'global' and not name:
+            return "Settings layer {0} needs a name".format(scope)
+        where = (Settingslayer.scope == scope) & (Settingslayer.name == name)
+        label = scope if scope == 'global' else "{0} {1}".format(scope, name)
+
+        try:
+            if settings is None:
+                nrows = Settingslayer.delete().where(where).execute()
+                message = "{0} settings removed: {1} row deleted".format(label, nrows)
+            else:
+                try:
+                    parse_settings(settings)
+                except ValueError, e:
+                    return "Cannot define {0} settings: {1}".format(label, str(e))
+
+                with db.transaction():
+                    if Settingslayer.update(settings=settings).where(where).execute() == 0:
+                        Settingslayer.insert(scope=scope, name=name, settings=settings).execute()
+                message = "Stored {0} settings in database".format(label)
+            setcache.invalidate()
+        except Exception, e:
+            message = "Cannot store {0} settings in DB: {1}".format(label, str(e))
+            log.error(message)
+            return message
+
+        log.info(message)
+        notify('s_layer', message)
+        return message
+
+    def s_layers(self, otckey):
+        ''' Return all settings layers '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        layers = []
+        for l in Settingslayer.select().order_by(Settingslayer.scope, Settingslayer.name).naive():
+            layers.append({
+                'scope'     : l.scope,
+                'name'      : l.name,
+                'settings'  : l.settings,
+                })
+        return layers
+
+    def s_effective(self, otckey, imei):
+        ''' Return the settings IMEI gets, merged from all layers, with the
+            layer each value comes from '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        imei = imei.replace(' ', '')
+        gen = setcache.current()
+
+        query = (Otap
+            .select(Otap.imei, Otap.custid, Imeiset.sname)
+            .join(Imeiset, JOIN_LEFT_OUTER, on=(Otap.imei == Imeiset.imei))
+            .where(Otap.imei == imei))
+        try:
+            q = query.naive().get()
+        except Otap.DoesNotExist:
+            return "IMEI {0} not found".format(imei)
+
+        return effective_settings(q.custid, q.imei, q.sname, gen)
+
+    @mutates
+    def s_resend(self, otckey, imei):
+        ''' Send IMEI its settings at the next versioncheck even if they
+            haven't changed since they were last sent '''
+
+        if _keycheck(otckey) == False:
+            return "NOP"
+
+        dbconn()
+
+        imei = imei.replace(' ', '')
+
+        try:
+            n = resend_settings(Otap.imei == imei)
+        except Exception, e:
+            message = "Cannot update db: {0}".format(str(e))
+            log.error(message)
+            return message
+
+        if n == 0:
+            return "IMEI {0} not found".format(imei)
+
+        message = "{0} gets its settings at the next versioncheck".format(imei)
+        log.info(message)
+        notify('resend', message)
+        return message
+
+
 bottle_jsonrpc.register('/rpc', Methods())
 
 
@@ -741,50 +1879,82 @@ def versioncheck(custid, word):
 
     current_version = bottle.request.body.read()
 
-    dbconn()
-
-    flags = imei_getflags(imei)
+    vcrate.hit()
+    if retention.enabled():
+        retention.start()
 
+    flags = ""
     upgrade = 0
     settings = []
     new_version = ""
     tid = ""
 
     try:
-        o = Otap.get(Otap.imei == imei, Otap.custid == custid)
-
-        tid = o.tid or '??'
-        new_version = o.deliver
+        state, degraded = device_state(imei)
+        if state is not None:
+            flags = state['flags']
+        if state is None or state['custid'] != custid:
+            raise Otap.DoesNotExist
+
+        tid = state['tid'] or '??'
+        new_version = state['deliver']
         if new_version == '*':
             new_version = list_jars()[-1]
 
-        o.reported = current_version
         if device != 'SIMU':
-            o.lastcheck = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(time.time())))
-            o.save()
+            lastcheck = datetime.datetime.utcnow().replace(microsecond=0)
+            if current_version != state['reported']:
+                heartbeat(imei, lastcheck=lastcheck, reported=current_version)
+            else:
+                heartbeat(imei, lastcheck=lastcheck)
+            fleetcounters.move(state, dict(state, reported=current_version, lastcheck=lastcheck))
 
-        if o.block == 0 and o.deliver is not None and current_version != new_version:
+        if state['block'] == 0 and state['deliver'] is not None and current_version != new_version:
             upgrade = 1
 
-        if o.block == 0:
+            if not downloads.acquire(imei):
+                # All download slots taken; the device asks again at its next versioncheck
+                log.info("No download slot free for {0}; upgrade deferred".format(imei))
+                upgrade = 0
+
+        if upgrade == 1 and device != 'SIMU':
+            funnel.offer(imei, custid, new_version, current_version)
+
+        if state['block'] == 0:
             # Device is not being blocked, but it may have settings we want to push. Do it
 
-            settings_str = imei_settings(imei)
-            if settings_str is not None:
-                settings = expand_settings(settings_str)
+            # A copy: the list is shared through the cache
+            settings = list(state['settings'])
+
+            if degraded and state['once'] == 1:
+                # The once-only set can't be deleted now; the device
+                # gets it when the database is back
+                settings = []
+
+            if settings and device != 'SIMU' and state['once'] == 0:
+                # Permanently assigned settings are only sent again when
+                # they change (or `otc resend' asks for it)
+                sdigest = settings_digest(settings)
+                if sdigest == state['sdigest']:
+                    settings = []
+                else:
+                    heartbeat(imei, sdigest=sdigest)
+
+            if cf.pollhint and 'versionInterval' not in [kv['key'] for kv in state['settings']]:
+                # Spread devices' polls out; an interval in their own settings
+                # wins. It follows the load, so it's not part of the digest.
+                settings.append(dict(key='versionInterval', val=str(pollhint.interval(imei, custid))))
 
             if device == 'SIMU':
                 log.info("NOT clearing settings-delivery because SIMUlator")
-            else:
-                # Check if settings are once-only. If so, delete the record
+            elif state['sname'] is not None and state['once'] == 1 and not degraded:
+                # Settings are once-only: delete the record
                 try:
-                    q = Imeiset.select().where(Imeiset.imei == imei).get()
-                    if q.once == 1:
-                        query = Imeiset.delete().where(Imeiset.imei == imei)
-                        nrows = query.execute()
-                        message = "Imeiset deleted for {0} because once-only configured".format(imei)
-                        log.info(message)
-                        notify('versioncheck', message)
+                    query = Imeiset.delete().where(Imeiset.imei == imei)
+                    nrows = query.execute()
+                    message = "Imeiset deleted for {0} because once-only configured".format(imei)
+                    log.info(message)
+                    notify('versioncheck', message)
                 except:
                     pass
 
@@ -802,12 +1972,9 @@ def versioncheck(custid, word):
         'new_version' : new_version,
         'custid'      : custid,
     }
-    try:
-        if device != 'SIMU':
-            vlog = Versioncheck(**item)
-            vlog.save()
-    except Exception, e:
-        log.error("Cannot INSERT versioncheck log for {0} into DB: {1}".format(imei, str(e)))
+    if device != 'SIMU':
+        if not vclog.put(item):
+            log.error("Cannot queue versioncheck log for {0}: queue full".format(imei))
 
     resp = {
         'upgrade'     : upgrade,
@@ -872,17 +2039,39 @@ def otap_notify(custid, clientid):
         'result'    : otap_result,
         'tstamp'    : time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(time.time()))),
         'custid'    : custid,
+        'version'   : None,
+        'ok'        : 1 if rollout.succeeded(otap_result) else 0,
     }
-    try:
-        o = Otap.get(Otap.imei == imei, Otap.custid == custid)
 
-        item['tid'] = o.tid or "??"
+    try:
+        state, degraded = device_state(imei)
+        if state is not None and state['custid'] == custid:
+            item['tid'] = state['tid'] or "??"
+            item['version'] = state['deliver']
+            if item['version'] == '*':
+                item['version'] = (list_jars() or [None])[-1]
+
+            if device != 'SIMU':
+                lastcheck = datetime.datetime.utcnow().replace(microsecond=0)
+                heartbeat(imei, lastcheck=lastcheck)
+                fleetcounters.move(state, dict(state, lastcheck=lastcheck))
+
+            downloads.release(imei)
+            if device != 'SIMU':
+                funnel.notify(imei, otap_result)
+
+            if degraded:
+                # Counted against its rollout once the database is back
+                if not rolloutresults.put(dict(imei=imei, result=otap_result)):
+                    log.error("Cannot queue OTAP result of {0} for its rollout: queue full".format(imei))
+            else:
+                rollout_changed(rollout.record(imei, otap_result))
+    except Exception, e:
+        log.error("Cannot record OTAP result for {0}: {1}".format(imei, str(e)))
 
-        if device != 'SIMU':
-            o.lastcheck = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(time.time())))
-            o.save()
-    except:
-        pass
+    if device != 'SIMU':
+        if not notifylog.put(dict(item, device=device[:20], result=otap_result[:128])):
+            log.error("Cannot queue notify log for {0}: queue full".format(imei))
 
     message = "OTAP upgrade result for {custid}/{tid} ({device}) {imei}: {result}  {tstamp}".format(**item)
     log.info(message)
@@ -901,20 +2090,19 @@ def otap_notify(custid, clientid):
 def otap_get(custid):
     device, imei = agentinfo()
 
-    dbconn()
-
     log.info('OTAP request for cust={0} / {1} IMEI={2}'.format(custid, device, imei))
 
     tid = ""
     deliver = None
     try:
-        o = Otap.get(Otap.imei == imei, Otap.custid == custid)
+        state, degraded = device_state(imei)
+        if state is None or state['custid'] != custid:
+            raise Otap.DoesNotExist
 
-        tid = o.tid or "??"
-
-        if o.block == 0 and o.deliver is not None:
-            deliver = o.deliver
+        tid = state['tid'] or "??"
 
+        if state['block'] == 0 and state['deliver'] is not None:
+            deliver = state['deliver']
 
     except Otap.DoesNotExist:
         log.info("Requested OTAP cust={0}/IMEI={1} doesn't exist in database".format(custid, imei))
@@ -927,39 +2115,23 @@ def otap_get(custid):
         if deliver == '*':
             deliver = list_jars()[-1]
 
-        jarfile = "{0}/{1}.jar".format(cf.jardir, deliver)
         try:
-            statinfo = os.stat(jarfile)
-            octets = statinfo.st_size
+            jad = jad_descriptor(deliver)
+            if jad is None:
+                raise IOError("no JAR for this version in {0}".format(cf.jardir))
 
             response.content_type = 'text/vnd.sun.j2me.app-descriptor'
             response.set_header('X-JARversion', deliver)
             response.headers['Content-Disposition'] = 'attachment; filename="OwnTracks.jad"'
 
-            params = {
-                'octets'    : octets,
-                'jarURL'    : "%s/%s/OwnTracks.jar" % (cf.jarurl, deliver),
-                'deliver'   : deliver,
-            }
-
-            JAD = """\
-               MIDlet-1: AppMain,,general.AppMain
-               MIDlet-Jar-Size: {octets}
-               MIDlet-Jar-URL: {jarURL}
-               MIDlet-Name: OwnTracks
-               MIDlet-Permissions: javax.microedition.io.Connector.http, javax.microedition.io.Connector.https, javax.microedition.io.Connector.ssl, javax.microedition.io.Connector.socket
-               MIDlet-Vendor: Choral
-               MIDlet-Version: {deliver}
-               MicroEdition-Configuration: CLDC-1.1
-               MicroEdition-Profile: IMP-NG
-            """
-
             log.debug("OTAP: returning JAD descriptor")
 
             message = "Upgrade starting on {custid}/{tid} ({device}) {imei} {deliver}".format(tid=tid, device=device, imei=imei, deliver=deliver, custid=custid)
             log.info(message)
             notify('OTAupgrades', message)
-            return textwrap.dedent(JAD.format(**params))
+            if device != 'SIMU':
+                funnel.jad(imei, custid, deliver)
+            return jad
 
         except Exception, e:
             log.error("OTAP: {0} wanted {1} but {2}".format(imei, deliver, str(e)))
@@ -976,27 +2148,185 @@ def otap_get(custid):
 # file. We just send out the static file. I could use Bottle's static_file
 # but I want the filename to be 'OwnTracks.jar' so return a file object.
 #
+# How the bytes get to the device depends on `jardelivery':
+#   python      return the open file; Bottle hands it to the server's
+#               wsgi.file_wrapper if it has one (uWSGI uses sendfile(2) for
+#               this and, with `offload-threads', frees the worker while it
+#               runs) and streams it otherwise. `sendfile' is the same.
+#   x-accel     return only headers with X-Accel-Redirect: <jaraccel>/<version>.jar
+#               and let nginx send the file from an `internal' location
+#   x-sendfile  return only headers with X-Sendfile: <path> (Apache, lighttpd)
+#
+# Devices on flaky links resume aborted downloads, so in the python mode
+# we honour a single-range Range (and If-Range) header and
+# answer 206 with only the missing bytes. The ETag is the SHA1 of the JAR,
+# so a range is never spliced onto a different build of the same version.
+# In the x-accel and x-sendfile modes the web server does all of this.
+#
 # "GET /jars/0.10.65.jar HTTP/1.1" 200 241748 "-" "TC65i/123456789012345 Profile/IMP-NG Configuration/CLDC-1.1"
 
+JARDELIVERY = ('python', 'sendfile', 'x-accel', 'x-sendfile')
+
+if cf.jardelivery not in JARDELIVERY:
+    raise ValueError("Configuration error: jardelivery must be one of {0}, not `{1}'".format(", ".join(JARDELIVERY), cf.jardelivery))
+
+def parse_etags(header):
+    ''' Return the list of entity tags in an If-None-Match header '''
+
+    if header is None:
+        return []
+    return [t.strip() for t in header.split(',')]
+
+RANGESPEC = re.compile(r'^\s*(\d+-\d*|-\d+)\s*$')
+
+def valid_range(header):
+    ''' True if `header' is a syntactically valid bytes Range header. One
+        which isn't is ignored (RFC 7233 3.1), not answered with 416. '''
+
+    if not header.startswith('bytes='):
+        return False
+    for spec in header[6:].split(','):
+        if not RANGESPEC.match(spec):
+            return False
+        first, last = spec.strip().split('-')
+        if first and last and int(last) < int(first):
+            return False
+    return True
+
+def file_range(f, offset, length, blocksize):
+    ''' Yield `length' bytes of open file `f' from `offset', then close it '''
+
+    try:
+        f.seek(offset)
+        while length > 0:
+            part = f.read(min(length, blocksize))
+            if not part:
+                break
+            length -= len(part)
+            yield part
+    finally:
+        f.close()
+
 @bottle.route('/jars/<version:re:.*>/OwnTracks.jar', method='GET')
 def jarfile(version):
 
-    jarfile = "{0}/{1}.jar".format(cf.jardir, version)
+    jar = jarindex.get(version)
+    if jar is None:
+        log.error("Can't serve JAR {0}: no such version".format(version))
+        return bottle.HTTPResponse(status=404, body="ENOENT")
+
+    jarfile = jar['path']
+    device, imei = agentinfo()
 
-    try:
-        statinfo = os.stat(jarfile)
-        octets = statinfo.st_size
+    def sent(octets):
+        # What we're about to send, not necessarily what arrives
+        if device != 'SIMU':
+            funnel.jar(imei, version, octets)
+
+    response.content_type = 'application/java-archive'
+    response.headers['Content-Disposition'] = 'attachment; filename="OwnTracks.jar"'
+
+    if cf.jardelivery == 'x-accel':
+        log.info("Delivering {0} via X-Accel-Redirect".format(jarfile))
+        response.headers['X-Accel-Redirect'] = "{0}/{1}.jar".format(cf.jaraccel, version)
+        sent(jar['size'])
+        return ""
 
-        response.content_type = 'application/java-archive'
+    if cf.jardelivery == 'x-sendfile':
+        log.info("Delivering {0} via X-Sendfile".format(jarfile))
+        response.headers['X-Sendfile'] = os.path.abspath(jarfile)
+        sent(jar['size'])
+        return ""
+
+    try:
+        etag = '"{0}"'.format(jarindex.etag(version))
+        f = open(jarfile, 'rb')
+        st = os.fstat(f.fileno())
+        octets = st.st_size
+        lastmod = bottle.http_date(st.st_mtime)
+
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = lastmod
+        response.headers['Accept-Ranges'] = 'bytes'
+
+        if etag in parse_etags(request.environ.get('HTTP_IF_NONE_MATCH')):
+            f.close()
+            response.status = 304
+            return ""
+
+        ranges = None
+        rangeheader = request.environ.get('HTTP_RANGE')
+        ifrange = request.environ.get('HTTP_IF_RANGE')
+        if rangeheader is not None and valid_range(rangeheader) and (ifrange is None or ifrange in (etag, lastmod)):
+            ranges = list(bottle.parse_range_header(rangeheader, octets))
+
+            if not ranges:
+                f.close()
+                response.status = 416
+                response.headers['Content-Range'] = "bytes */{0}".format(octets)
+                return ""
+
+        if ranges is not None and len(ranges) == 1:
+            # bottle's ranges are [start, end)
+            start, end = ranges[0]
+            response.status = 206
+            response.headers['Content-Range'] = "bytes {0}-{1}/{2}".format(start, end - 1, octets)
+            response.headers['Content-Length'] = str(end - start)
+            log.info("Delivering {0} bytes {1}-{2}".format(jarfile, start, end - 1))
+            sent(end - start)
+            return file_range(f, start, end - start, cf.jarblocksize)
+
+        # Several ranges are rare enough that we just send the whole JAR
         response.headers['Content-Length'] = str(octets)
         log.info("Delivering {0}".format(jarfile))
-        f = open(jarfile, 'rb')
+        sent(octets)
         return f
     except Exception, e:
         log.error("Can't serve JAR {0}: {1}".format(version, str(e)))
         return bottle.HTTPResponse(status=404, body="ENOENT")
 
 
+# --- EXPORT
+# Stream all devices or the whole versioncheck log as NDJSON, one JSON object
+# per line, for otc dbjson and otc export. The rows are read in keyset pages
+# of pagemax rows and written out as they're read, so neither the server nor
+# the client holds the whole table; the database connection is returned to
+# the pool between pages. If reading fails part way, the last line is
+# {"error": <message>} so that the client doesn't take the rows so far for
+# the whole table. Authenticated with an otc token in ?otckey=
+
+def export_rows(what):
+    cursor = None
+    try:
+        while True:
+            dbconn()
+            if what == 'devices':
+                rows, cursor = page_devices(cursor, cf.pagemax)
+            else:
+                rows, cursor = page_versionlog(cursor, cf.pagemax)
+            dbclose()
+
+            for row in rows:
+                yield json.dumps(row) + "\n"
+
+            if cursor is None:
+                break
+    except Exception, e:
+        log.error("Export of {0} failed: {1}".format(what, str(e)))
+        yield json.dumps({ 'error' : "Export of {0} failed: {1}".format(what, str(e)) }) + "\n"
+    finally:
+        dbclose()
+
+@bottle.route('/export/<what:re:(devices|versionlog)>', method='POST')
+def export(what):
+
+    # The key comes in the body, not the URL, which is logged
+    if _keycheck(request.forms.get('otckey')) == False:
+        return bottle.HTTPResponse(status=403, body="NOP")
+
+    response.content_type = 'application/x-ndjson'
+    return export_rows(what)
+
 @bottle.route('/jarupload', method='POST')
 def jarupload():
 
@@ -1035,14 +2365,30 @@ def jarupload():
         os.makedirs(cf.jardir)
 
     path = "{0}/{1}.jar".format(cf.jardir, midlet_version)
+    tmp = "{0}/.{1}.jar.{2}".format(cf.jardir, midlet_version, os.getpid())
     try:
-        upload.save(path, overwrite=overwrite)
+        if os.path.exists(path) and not overwrite:
+            raise IOError("File exists.")
+        # Write a hidden file and rename it into place: a replaced JAR
+        # changes the directory, so every worker's JarIndex rescans, and
+        # nobody ever reads a half-written JAR
+        upload.save(tmp, overwrite=True)
+        os.rename(tmp, path)
         log.info("Saved uploaded JAR as {0}".format(path))
     except Exception, e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
         s = "Cannot save {0}: {1}".format(path, str(e))
         log.error(s)
         notify('jarupload', s)
         return s
+    finally:
+        jarindex.invalidate()
+
+    # Render the descriptor and hash the JAR now rather than on the first
+    # device's request
+    jad_descriptor(midlet_version)
+    jarindex.etag(midlet_version)
 
 
     message = "JAR version {0} stored as {1}".format(midlet_version, path)
@@ -1057,6 +2403,13 @@ def jarupload():
 createalltables()
 bottle.debug(True)
 
+try:
+    # Flush write-behind queues when a uWSGI worker is stopped or reloaded
+    import uwsgi
+    uwsgi.atexit = writebehind.shutdown
+except ImportError:
+    pass
+
 if __name__ == '__main__':
     # Standalone web server
     bottle.run(reloader=True,
@@ -15,6 +15,8 @@ import warnings
 from requests_toolbelt import MultipartEncoder
 import requests
 import json
+import time
+import shlex
 
 with warnings.catch_warnings():
     ''' Suppress cffi/vengine_cpy.py:166: UserWarning: reimporting '_cffi__x332a1fa9xefb54d7c' might overwrite older definitions '''
@@ -24,14 +26,22 @@ with warnings.catch_warnings():
     import nacl.utils
     from nacl.encoding import Base64Encoder
 
-version = '0.12'
+version = '0.13'
 secret_text = b"OvEr.THe.aIR*"
 
+# Servers older than otc 0.13 don't understand timestamped tokens and
+# answer "NOP". Old-style tokens, without timestamp, are sent only if
+# OTC_LEGACY is set: they can be replayed, and a refusal may just as well
+# mean a skewed clock or a replayed token.
+legacy = os.getenv("OTC_LEGACY") is not None
+
 def make_secret(message):
     try:
         key = base64.b64decode(os.getenv("OTC_KEY"))
         box = nacl.secret.SecretBox(key)
         nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
+        if not legacy:
+            message = message + b'@' + str(int(time.time()))
         encrypted = box.encrypt(message, nonce)
 
         b64 = base64.b64encode(encrypted)
@@ -40,21 +50,66 @@ def make_secret(message):
         print "Can't make secret from OTC_KEY: ", str(e)
         sys.exit(1)
 
+def refused():
+    ''' Explain a "NOP" on stderr '''
+
+    if not legacy:
+        sys.stderr.write("Server refused the token: check OTC_KEY and the clocks; set OTC_LEGACY for servers older than otc 0.13\n")
+
 
 class RPC(object):
     def __init__(self, otc_url, otc_secret):
+        self.otc_url = otc_url
+        self.url = "%s/rpc" % otc_url
         self.server = pyjsonrpc.HttpClient(
-            url = "%s/rpc" % otc_url,
+            url = self.url,
             username = None,
             password = None,
             )
 
-    def _request(self, cmd, *args):
+    def batch(self, calls, chunk=100):
+        ''' Run a list of (method, params) as JSON-RPC batches of `chunk'
+            calls, each batch in one HTTP request with one token. Yields a
+            (result, error) tuple per call, in order. '''
+
+        session = requests.Session()
+        headers = { 'Content-Type' : 'application/json' }
+
+        for n in range(0, len(calls), chunk):
+            b64 = make_secret(secret_text)
+            payload = []
+            for i, (method, params) in enumerate(calls[n:n + chunk]):
+                payload.append({
+                    'jsonrpc'   : '2.0',
+                    'method'    : method,
+                    'params'    : [b64] + list(params),
+                    'id'        : n + i,
+                })
+
+            responses = {}
+            try:
+                r = session.post(self.url, data=json.dumps(payload), headers=headers)
+                for resp in r.json():
+                    responses[resp['id']] = resp
+            except Exception, e:
+                print "Error talking to server: {0}".format(str(e))
+
+            nops = [resp.get('result') == "NOP" for resp in responses.itervalues()]
+            if nops and all(nops):
+                refused()
+
+            for i in range(n, n + len(payload)):
+                resp = responses.get(i, { 'result' : None, 'error' : { 'message' : 'no response' } })
+                error = resp.get('error')
+                yield resp.get('result'), error['message'] if isinstance(error, dict) else error
 
-        b64 = make_secret(secret_text)
+    def _request(self, cmd, *args):
 
         try:
-            return self.server.call(cmd, b64, *args)
+            result = self.server.call(cmd, make_secret(secret_text), *args)
+            if result == "NOP":
+                refused()
+            return result
         except Exception, e:
             print("Error talking to server: {0}".format(str(e)))
             return None
@@ -62,9 +117,66 @@ class RPC(object):
     def ping(self):
         return self._request('ping')
 
+    def fleet(self, action, selector, arg=None, dryrun=0, once=0):
+        return self._request('fleet', action, selector, arg, dryrun, once)
+
+    def rollout_start(self, version, selector, wavesize=0, percent=0, advance=90):
+        return self._request('rollout_start', version, selector, wavesize, percent, advance)
+
+    def rollout_status(self):
+        return self._request('rollout_status')
+
+    def rollout_ctl(self, rid, action):
+        return self._request('rollout_ctl', rid, action)
+
     def show(self, imei=None):
         return self._request('show', imei)
 
+    def pages(self, cmd, limit, *args):
+        ''' Call the paginated RPC `cmd' until there are no more pages,
+            yielding each page's rows as it arrives '''
+
+        cursor = None
+        while True:
+            page = self._request(cmd, cursor, limit, *args)
+            if not isinstance(page, dict):
+                if page is not None:
+                    print page
+                return
+            yield page['rows']
+            cursor = page['cursor']
+            if cursor is None:
+                return
+
+    def export(self, what):
+        ''' Stream /export/<what> and yield its rows as they arrive. Exits
+            if the export fails, possibly after some rows, so that partial
+            output isn't mistaken for a complete one. '''
+
+        try:
+            # The token goes in the body: URLs end up in access logs
+            r = requests.post("%s/export/%s" % (self.otc_url, what), data={ 'otckey' : make_secret(secret_text) }, stream=True)
+            if r.status_code == 403:
+                refused()
+            if r.status_code != 200:
+                error = "{0} {1}".format(r.status_code, r.text)
+            else:
+                error = None
+                for line in r.iter_lines():
+                    if line:
+                        row = json.loads(line)
+                        if row.keys() == ['error']:
+                            error = row['error']
+                            break
+                        yield row
+        except Exception, e:
+            error = str(e)
+
+        if error is not None:
+            sys.stdout.flush()
+            sys.stderr.write("\nError talking to server: {0}\n".format(error))
+            sys.exit(1)
+
     def find(self, word):
         return self._request('find', word)
 
@@ -101,6 +213,27 @@ class RPC(object):
     def versionlog(self, count):
         return self._request('versionlog', count)
 
+    def serverstats(self):
+        return self._request('serverstats')
+
+    def fleetstats(self, custid=None, rebuild=0):
+        return self._request('fleetstats', custid, rebuild)
+
+    def versionstats(self, imei=None, custid=None, days=30):
+        return self._request('versionstats', imei, custid, days)
+
+    def versionhistory(self, imei, days=30):
+        return self._request('versionhistory', imei, days)
+
+    def retention(self):
+        return self._request('retention')
+
+    def funnel(self, version=None, custid=None, days=30):
+        return self._request('funnel', version, custid, days)
+
+    def dbcheck(self):
+        return self._request('dbcheck')
+
     def showsets(self, imei=None):
         return self._request('showsets', imei)
 
@@ -113,8 +246,99 @@ class RPC(object):
     def s_set(self, imei, name, bf, once):
         return self._request('s_set', imei, name, bf, once)
 
-def print_devices(data):
-    print "B IMEI             CUSTID    TID  Reported   Deliver    Settings    FLAGS Last chk/notif"
+    def s_resend(self, imei):
+        return self._request('s_resend', imei)
+
+    def s_layer(self, scope, name, settings):
+        return self._request('s_layer', scope, name, settings)
+
+    def s_layers(self):
+        return self._request('s_layers')
+
+    def s_effective(self, imei):
+        return self._request('s_effective', imei)
+
+# otc command -> (RPC method, minimum, maximum number of arguments)
+BATCH_COMMANDS = {
+    'ping'          : ('ping', 0, 0),
+    'show'          : ('show', 0, 1),
+    'find'          : ('find', 1, 1),
+    'setcomment'    : ('setcomment', 2, 2),
+    'setflags'      : ('setflags', 2, 2),
+    'jars'          : ('jars', 0, 0),
+    'add'           : ('add_imei', 3, 3),
+    'deliver'       : ('deliver', 2, 2),
+    'purge'         : ('purge', 1, 1),
+    'define'        : ('s_define', 2, 2),
+    'undef'         : ('s_undef', 1, 1),
+    'showsets'      : ('showsets', 0, 1),
+    'resend'        : ('s_resend', 1, 1),
+}
+
+def batch_command(line):
+    ''' Translate a line of a batch file, written like the arguments of an
+        otc command (e.g. `deliver 123456789012345 0.10.65'), into an RPC
+        method and its parameters (without the key). '''
+
+    argv = shlex.split(line)
+    cmd, args = argv[0], argv[1:]
+
+    if cmd in ('block', 'unblock'):
+        bl = 1 if cmd == 'block' else 0
+        if args == ['--all']:
+            return 'block', ['ALL', bl]
+        if len(args) == 1:
+            return 'block', [args[0], bl]
+
+    elif cmd in ('set', 'unset'):
+        once = 0
+        if cmd == 'set' and args[:1] == ['--once']:
+            once = 1
+            args = args[1:]
+        if len(args) == 2:
+            return 's_set', [args[0], args[1], 1 if cmd == 'set' else 0, once]
+
+    elif cmd == 'imei':
+        if len(args) in (1, 2):
+            custid = args[1] if len(args) == 2 else None
+            return 'imei', [custid, args[0]]
+
+    elif cmd == 'versionlog':
+        if len(args) <= 1:
+            return 'versionlog', [int(args[0]) if args else 40]
+
+    elif cmd in BATCH_COMMANDS:
+        method, minargs, maxargs = BATCH_COMMANDS[cmd]
+        if minargs <= len(args) <= maxargs:
+            return method, args + [None] * (maxargs - len(args))
+
+    else:
+        raise ValueError("unsupported command `{0}'".format(cmd))
+
+    raise ValueError("wrong number of arguments for `{0}'".format(cmd))
+
+def fleet_selector(args):
+    ''' Build the selector for the fleet RPC from otc's options '''
+
+    selector = {}
+    if args['--custid']:
+        selector['custid'] = args['--custid']
+    if args['--tid']:
+        selector['tid'] = [t.strip() for t in args['--tid'].split(',') if t.strip()]
+    if args['--reported']:
+        selector['reported'] = args['--reported']
+    if args['--flag']:
+        selector['flags'] = args['--flag']
+    if args['--imeifile']:
+        f = sys.stdin if args['--imeifile'] == '-' else open(args['--imeifile'])
+        selector['imei'] = [l.strip() for l in f if l.strip() and not l.startswith('#')]
+    if args['--all']:
+        selector['all'] = True
+    return selector
+
+def print_devices(data, header=True):
+    if header:
+        print "B IMEI             CUSTID    TID  Reported   Deliver    Settings    FLAGS Last chk/notif"
     for item in data:
         if item['sname'] is None:
             item['sname'] = '-'
@@ -126,8 +350,8 @@ if __name__ == '__main__':
 
     Usage:
       otc ping
-      otc show [<imei>]
-      otc find <word>
+      otc show [<imei>] [--page=<n>]
+      otc find <word> [--page=<n>]
       otc imei <tid> [<custid>]
       otc setcomment <imei> <text>
       otc setflags <imei> <flagstring>
@@ -142,19 +366,46 @@ if __name__ == '__main__':
       otc otap <imei> <custid>
       otc showconfig <custid>
       otc versionlog [<count>]
+      otc export <what>
+      otc notifylog [<version>] [--imei=<imei>] [--custid=<custid>] [--since=<time>] [--until=<time>] [--failed] [--page=<n>]
+      otc stats [<custid>] [--rebuild]
+      otc versionstats [--imei=<imei>] [--custid=<custid>] [--days=<n>]
+      otc history <imei> [--days=<n>]
+      otc retention
+      otc funnel [<version>] [--custid=<custid>] [--days=<n>]
       otc define <name> <settings>
       otc undef <name>
       otc showsets [<imei>]
       otc set [--once] <imei> <name>
       otc unset <imei> <name>
+      otc resend <imei>
+      otc layer <layer> (<settings> | --clear)
+      otc layers
+      otc effective <imei>
       otc dbjson
+      otc rollout start <version> (--wave=<n> | --percent=<p>) [--advance=<p>] [--custid=<custid>] [--tid=<tids>] [--reported=<version>] [--flag=<flag>] [--imeifile=<file>] [--all]
+      otc rollout status
+      otc rollout (pause | resume | advance | abort) <id>
+      otc serverstats
+      otc dbcheck
+      otc batch [<file>] [--chunk=<n>]
+      otc fleet <action> [<arg>] [--custid=<custid>] [--tid=<tids>] [--reported=<version>] [--flag=<flag>] [--imeifile=<file>] [--all] [--once] [--dry-run]
 
       otc (-h | --help)
       otc --version
 
     Options:
-      -h --help     Show this screen.
-      --version     Show version.
+      -h --help       Show this screen.
+      --version       Show version.
+      --chunk=<n>     Commands per batch request [default: 100].
+      --page=<n>      Rows per page [default: 100].
+      --days=<n>      Days of history to count [default: 30].
+      --since=<time>  From this UTC time (YYYY-MM-DD[ HH:MM[:SS]]).
+      --until=<time>  Before this UTC time.
+      --failed        Only failed upgrades.
+      --clear         Remove the settings layer.
+      --dry-run       Only show how many devices fleet would change.
+      --advance=<p>   Percentage of successful upgrades before the next wave [default: 90].
     '''
 
     otc_url = os.getenv("OTC_URL")
@@ -177,18 +428,34 @@ if __name__ == '__main__':
         print rpc.ping()
 
     if args['show']:
-        data = rpc.show(args['<imei>'])
-        if data is not None:
-            print_devices(data)
+        if args['<imei>']:
+            data = rpc.show(args['<imei>'])
+            if data is not None:
+                print_devices(data)
+        else:
+            header = True
+            for data in rpc.pages('show_page', int(args['--page'])):
+                print_devices(data, header)
+                header = False
 
     if args['dbjson']:
-        data = rpc.show()
-        print json.dumps(data, indent=4)
+        # Printed as the rows arrive; the output is the same JSON array
+        sep = "[\n"
+        for item in rpc.export('devices'):
+            sys.stdout.write(sep + json.dumps(item, indent=4))
+            sep = ",\n"
+        print "[]" if sep == "[\n" else "\n]"
+
+    if args['export']:
+        # devices or versionlog, as JSON, one row per line
+        for item in rpc.export(args['<what>']):
+            print json.dumps(item)
 
     if args['find']:
-        data = rpc.find(args['<word>'])
-        if data is not None:
-            print_devices(data)
+        header = True
+        for data in rpc.pages('show_page', int(args['--page']), args['<word>']):
+            print_devices(data, header)
+            header = False
 
     if args['imei']:
         print rpc.imei(args['<custid>'], args['<tid>'])
@@ -242,6 +509,27 @@ if __name__ == '__main__':
 
         print rpc.s_set(args['<imei>'], args['<name>'], bf, once)
 
+    if args['resend']:
+        print rpc.s_resend(args['<imei>'])
+
+    if args['layer']:
+        # global, custid:<custid> or imei:<imei>
+        scope, _, name = args['<layer>'].partition(':')
+        print rpc.s_layer(scope, name or None, None if args['--clear'] else args['<settings>'])
+
+    if args['layers']:
+        for l in rpc.s_layers() or []:
+            layer = l['scope'] if l['scope'] == 'global' else "%s:%s" % (l['scope'], l['name'])
+            print "%-28s %s" % (layer, l['settings'])
+
+    if args['effective']:
+        res = rpc.s_effective(args['<imei>'])
+        if isinstance(res, list):
+            for kv in res:
+                print "%-24s %-28s %s" % (kv['key'], kv['source'], kv['val'])
+        else:
+            print res
+
     if args['versionlog']:
         count = 40
 
@@ -252,6 +540,111 @@ if __name__ == '__main__':
         for l in logs:
             print "%(imei)-17s %(version)-10s %(tstamp)-20s upgrade=%(upgrade)s" % l
 
+    if args['notifylog']:
+        for rows in rpc.pages('notifylog_page', int(args['--page']), args['--imei'], args['--custid'],
+                    args['<version>'], args['--since'], args['--until'], 1 if args['--failed'] else 0):
+            for l in rows:
+                l['status'] = 'ok' if l['ok'] else 'FAILED'
+                l['version'] = l['version'] or '-'
+                print "%(tstamp)-20s %(imei)-17s %(custid)s/%(tid)s %(version)-10s %(status)-6s %(result)s" % l
+
+    if args['batch']:
+        # Commands, one per line, as they'd be given to otc
+        f = sys.stdin
+        if args['<file>'] not in (None, '-'):
+            f = open(args['<file>'])
+
+        lines = []
+        calls = []
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                calls.append(batch_command(line))
+                lines.append(line)
+            except Exception, e:
+                print "{0}: ERROR {1}".format(line, str(e))
+
+        for line, (result, error) in zip(lines, rpc.batch(calls, int(args['--chunk']))):
+            if error is not None:
+                print "{0}: ERROR {1}".format(line, error)
+            elif isinstance(result, basestring):
+                print "{0}: {1}".format(line, result)
+            else:
+                print "{0}: {1}".format(line, json.dumps(result))
+
+    if args['fleet']:
+        once = 1 if args['--once'] else 0
+        dryrun = 1 if args['--dry-run'] else 0
+        print rpc.fleet(args['<action>'], fleet_selector(args), args['<arg>'], dryrun, once)
+
+    if args['rollout']:
+        if args['start']:
+            wavesize = int(args['--wave'] or 0)
+            percent = int(args['--percent'] or 0)
+            print rpc.rollout_start(args['<version>'], fleet_selector(args), wavesize, percent, int(args['--advance']))
+        elif args['status']:
+            for r in rpc.rollout_status() or []:
+                print "%(id)4d %(version)-10s %(state)-8s wave %(wave)d/%(waves)d of %(wavesize)d  released %(released)d ok %(ok)d failed %(failed)d (advance at %(advance)d%%) %(selector)s" % r
+        else:
+            for action in ('pause', 'resume', 'advance', 'abort'):
+                if args[action]:
+                    print rpc.rollout_ctl(int(args['<id>']), action)
+
+    if args['dbcheck']:
+        res = rpc.dbcheck()
+        if isinstance(res, dict):
+            print "Schema version {0}".format(res['schemaversion'])
+            for name, check in sorted(res['queries'].items()):
+                verdict = { True : 'index', False : 'NO INDEX', None : 'ERROR' }[check['index']]
+                print "%-14s %s" % (name, verdict)
+                for line in check['plan']:
+                    print "               %s" % line
+        else:
+            print res
+
+    if args['stats']:
+        res = rpc.fleetstats(args['<custid>'], 1 if args['--rebuild'] else 0)
+        if isinstance(res, dict):
+            print "CUSTID     Devices Blocked Pending  Silent>1h  >24h   >7d  never"
+            for custid, st in sorted(res.items()):
+                print "%-10s %7d %7d %7d  %9d %5d %5d %6d" % (custid, st['devices'], st['blocked'], st['pending'],
+                    st['silent']['1h'], st['silent']['24h'], st['silent']['7d'], st['silent']['never'])
+                versions = sorted(st['versions'].items(), key=lambda v: -v[1])
+                print "           " + "  ".join("%s: %d" % v for v in versions)
+        else:
+            print res
+
+    if args['versionstats']:
+        for r in rpc.versionstats(args['--imei'], args['--custid'], int(args['--days'])) or []:
+            print "%(version)-10s upgrade=%(upgrade)s %(count)8d" % r
+
+    if args['history']:
+        for r in rpc.versionhistory(args['<imei>'], int(args['--days'])) or []:
+            print "%(period)-20s %(version)-10s upgrade=%(upgrade)s %(count)6d" % r
+
+    if args['retention']:
+        print rpc.retention()
+
+    if args['funnel']:
+        res = rpc.funnel(args['<version>'], args['--custid'], int(args['--days']))
+        if isinstance(res, dict):
+            print "Version    Offered     JAD     JAR    Done  Failed Abandon  Open   p50/p90/p99 (s)      Bytes/upgrade"
+            for version, f in sorted(res.items()):
+                t = f['time_to_upgrade']
+                times = "/".join('-' if t[p] is None else "%d" % t[p] for p in ('p50', 'p90', 'p99'))
+                print "%-10s %7d %7d %7d %7d %7d %7d %5d   %-20s %s" % (version, f['offered'], f['jad'], f['jar'],
+                    f['done'], f['failed'], f['abandoned'], f['open'], times, f['bytes_per_upgrade'] or '-')
+                c = f['conversion']
+                print "           " + "  ".join("%s: %s" % (k, '-' if c[k] is None else "%.1f%%" % (c[k] * 100))
+                    for k in ('offered_jad', 'jad_jar', 'jar_done', 'offered_done'))
+        else:
+            print res
+
+    if args['serverstats']:
+        print json.dumps(rpc.serverstats(), indent=4)
+
     if args['showsets']:
         res = rpc.showsets(args['<imei>'])
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import time
+import sqlite3
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+class DownloadSlots(object):
+    ''' Limit the number of devices upgrading at the same time. A device
+        takes a slot when it is told to upgrade and gives it back when it
+        notifies its result; a slot not given back within `ttl' seconds
+        (the device never notified) is freed. With `maxslots' 0 there is
+        no limit. '''
+
+    def __init__(self, maxslots=0, ttl=900):
+        self.maxslots = maxslots
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.granted = 0
+        self.denied = 0
+
+    def acquire(self, imei):
+        ''' Return True if `imei' holds a slot (it may already have one) '''
+
+        if not self.maxslots:
+            return True
+
+        now = time.time()
+        with self.lock:
+            for k in [k for k, expires in self.slots.iteritems() if expires < now]:
+                del self.slots[k]
+
+            if imei not in self.slots and len(self.slots) >= self.maxslots:
+                self.denied += 1
+                return False
+
+            if imei not in self.slots:
+                self.granted += 1
+            self.slots[imei] = now + self.ttl
+            return True
+
+    def release(self, imei):
+        with self.lock:
+            self.slots.pop(imei, None)
+
+    def stats(self):
+        return {
+            'max'       : self.maxslots,
+            'in_use'    : len(self.slots),
+            'granted'   : self.granted,
+            'denied'    : self.denied,
+        }
+
+class SharedDownloadSlots(DownloadSlots):
+    ''' Like DownloadSlots, but kept in an SQLite file at `path' so that the
+        limit applies to all uWSGI workers on a host together. '''
+
+    def __init__(self, path, maxslots=0, ttl=900):
+        DownloadSlots.__init__(self, maxslots, ttl)
+        self.path = path
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS slots (imei TEXT PRIMARY KEY, expires REAL)")
+        return self.conn
+
+    def acquire(self, imei):
+        if not self.maxslots:
+            return True
+
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+
+            # BEGIN IMMEDIATE serializes the count and the insert between workers
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM slots WHERE expires < ?", (now,))
+                held = conn.execute("SELECT COUNT(*) FROM slots WHERE imei = ?", (imei,)).fetchone()[0]
+                inuse = conn.execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+
+                if not held and inuse >= self.maxslots:
+                    conn.execute("COMMIT")
+                    self.denied += 1
+                    return False
+
+                conn.execute("INSERT OR REPLACE INTO slots (imei, expires) VALUES (?, ?)", (imei, now + self.ttl))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+
+            if not held:
+                self.granted += 1
+            return True
+
+    def release(self, imei):
+        with self.lock:
+            self.connect().execute("DELETE FROM slots WHERE imei = ?", (imei,))
+
+    def stats(self):
+        with self.lock:
+            try:
+                inuse = self.connect().execute("SELECT COUNT(*) FROM slots WHERE expires >= ?", (time.time(),)).fetchone()[0]
+            except Exception, e:
+                log.error("Cannot count download slots in {0}: {1}".format(self.path, str(e)))
+                inuse = None
+
+        return {
+            'max'       : self.maxslots,
+            'in_use'    : inuse,
+            'granted'   : self.granted,
+            'denied'    : self.denied,
+            'path'      : self.path,
+        }
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import time
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+class CircuitBreaker(object):
+    ''' Stop using the database after `failures' lookups in a row failed or
+        took longer than `slow' seconds (0: never too slow). While the breaker
+        is open, allow() is False and callers answer without the database;
+        after `cooldown' seconds one caller is let through to try it again,
+        and the breaker closes if that works, calling `onclose' (if given).
+        The breaker is per process. '''
+
+    def __init__(self, failures=5, cooldown=30, slow=0, onclose=None):
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.slow = slow
+        self.onclose = onclose
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.errors = 0             # consecutive failures
+        self.opened = None          # when it opened or last let a trial through
+
+        self.trips = 0
+        self.rejected = 0
+
+    def tripped(self):
+        ''' True while the database shouldn't be used at all '''
+
+        return self.state != 'closed'
+
+    def allow(self):
+        ''' Return True if the caller may use the database and must then
+            report the outcome with success() or failure() '''
+
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            now = time.time()
+            if now - self.opened >= self.cooldown:
+                # One trial per cooldown, even if its caller never reports back
+                self.state = 'half-open'
+                self.opened = now
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self, elapsed=0):
+        if self.slow and elapsed > self.slow:
+            log.warning("Database lookup took {0:.1f}s".format(elapsed))
+            self.failure()
+            return
+
+        with self.lock:
+            reopened = self.state != 'closed'
+            self.state = 'closed'
+            self.errors = 0
+
+        if reopened:
+            log.info("Database is back; circuit breaker closed")
+            if self.onclose is not None:
+                self.onclose()
+
+    def failure(self):
+        with self.lock:
+            self.errors += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.errors >= self.failures):
+                if self.state == 'closed':
+                    self.trips += 1
+                    log.error("Database failing; circuit breaker open for {0}s".format(self.cooldown))
+                self.state = 'open'
+                self.opened = time.time()
+
+    def stats(self):
+        return {
+            'state'     : self.state,
+            'errors'    : self.errors,
+            'trips'     : self.trips,
+            'rejected'  : self.rejected,
+        }
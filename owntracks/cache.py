@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import time
+import threading
+import logging
+from collections import OrderedDict
+from owntracks.generation import Generation
+
+log = logging.getLogger(__name__)
+
+class LRUCache(object):
+    ''' Hold at most `maxsize' entries (0: none), evicting the least
+        recently used. All entries are dropped when the `generation'
+        counter (see owntracks/generation.py; one of this process by
+        default) changes, which invalidate() does. With a `ttl', entries
+        are also dropped that many seconds after they were stored. A value
+        read from the database is only stored if the generation hasn't
+        changed since before it was read:
+
+            gen = cache.current()
+            value = cache.get(key, MISSING)
+            if value is MISSING:
+                value = load(key)
+                cache.put(key, value, gen)
+    '''
+
+    def __init__(self, maxsize=10000, generation=None, ttl=None):
+        self.maxsize = max(0, maxsize)
+        self.generation = generation or Generation()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()        # key -> (value, expiry)
+        self.seen = self.generation.current()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.clears = 0
+        self.invalidations = 0
+
+    def current(self):
+        return self.generation.current()
+
+    def check(self, current):
+        ''' Drop everything if the generation changed. Called with the lock held. '''
+
+        if current != self.seen:
+            self.entries.clear()
+            self.seen = current
+            self.clears += 1
+
+    def get(self, key, default=None):
+        current = self.generation.current()
+        with self.lock:
+            self.check(current)
+            try:
+                value, expiry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expiry is not None and expiry <= time.time():
+                self.expired += 1
+                self.misses += 1
+                return default
+            self.entries[key] = (value, expiry)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        current = self.generation.current()
+        if generation is not None and generation != current:
+            # The data changed while `value' was being read
+            return
+        if self.maxsize == 0:
+            return
+
+        expiry = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.check(current)
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expiry)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, values):
+        ''' Update the cached dict of `key', if any, with `values': for
+            changes made by this process which needn't invalidate others '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[0].update(values)
+
+    def discard(self, keys):
+        ''' Drop the entries of `keys' from this cache only '''
+
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def invalidate(self):
+        ''' Drop everything here and, through the generation, in every
+            cache sharing it. Call after the underlying data changed. '''
+
+        self.generation.bump()
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            size = len(self.entries)
+
+        return {
+            'size'      : size,
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'expired'   : self.expired,
+            'evictions' : self.evictions,
+            'clears'    : self.clears,
+            'invalidations' : self.invalidations,
+        }
@@ -30,11 +30,69 @@ class Config(RawConfigParser):
         self.dbhost     = 'localhost'
         self.dbport     = 3306
         self.dbpath     = '/tmp/otap.db'
+        self.dbpoolsize = 8
+        self.dbpoolwait = 10
+        self.dbpoolstale = 300
+        self.dbfailures = 5
+        self.dbcooldown = 30
+        self.dbslow     = 5
+        self.snapshotinterval = 300
+        self.snapshotfile = None
 
         self.jarurl     = 'http://localhost:8810/jars'
         self.jardir     = '/tmp/jars'
         self.otckey     = None
+        self.otclegacy  = False
+        self.noncewindow = 300
+        self.noncemax   = 100000
+        self.noncestore = None
         self.notify     = None
+        self.notifyhost = 'localhost'
+        self.notifyport = 1883
+        self.notifyqueue = 1000
+        self.notifybatch = 100
+        self.notifypolicy = 'drop'
+        self.notifyspool = None
+
+        self.jardelivery  = 'python'
+        self.jaraccel     = '/otap-jars'
+        self.jarblocksize = 65536
+
+        self.vlogbatch  = 200
+        self.vlogdelay  = 5
+        self.vlogqueue  = 10000
+        self.hbinterval = 30
+        self.statsinterval = 10
+        self.statsreconcile = 3600
+        self.funneldelay = 5
+        self.funnelqueue = 10000
+        self.vlograw    = None
+        self.vloghourly = None
+        self.vlogdaily  = None
+        self.vlogchunk  = 500
+        self.vlogprune  = 3600
+
+        self.setcache   = 10000
+        self.setcachestore = '/tmp/otap-setcache'
+        self.devcache   = 10000
+        self.devcachettl = 60
+        self.devcachestore = '/tmp/otap-devcache'
+
+        self.dlslots    = 0
+        self.dlslotttl  = 900
+        self.dlslotstore = None
+
+        self.pagesize   = 100
+        self.pagemax    = 1000
+
+        self.pollhint   = False
+        self.pollbase   = 10800
+        self.pollfloor  = 3600
+        self.pollceiling = 43200
+        self.polltarget = 5.0
+        self.polljitter = 0.2
+        self.pollstep   = 60
+        self.pollwindow = 60
 
         RawConfigParser.__init__(self)
         try:
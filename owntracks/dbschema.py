@@ -5,6 +5,9 @@ __copyright__ = 'Copyright 2014 Jan-Piet Mens'
 __license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
 
 from peewee import *
+from playhouse.pool import PooledPostgresqlDatabase, PooledMySQLDatabase, PooledSqliteDatabase, MaxConnectionsExceeded
+from playhouse.migrate import SchemaMigrator
+from playhouse import migrate as migrations
 from owntracks import cf
 import datetime
 import os
@@ -15,19 +18,34 @@ log = logging.getLogger(__name__)
 
 db = None
 
+# Connections are pooled per process: at most dbpoolsize are open, requests
+# wait up to dbpoolwait seconds for one to become free, and connections
+# older than dbpoolstale seconds are closed instead of being reused. A
+# connection taken from the pool is checked first (MySQL: ping), so one the
+# server has dropped (MySQL 2006) is replaced rather than handed out.
+pool = {
+    'max_connections'   : cf.dbpoolsize,
+    'stale_timeout'     : cf.dbpoolstale,
+    'timeout'           : cf.dbpoolwait,
+}
+
 engines = {
-    'postgresql' : PostgresqlDatabase(cf.dbname,
+    'postgresql' : PooledPostgresqlDatabase(cf.dbname,
                         user=cf.dbuser,
                         port=cf.dbport,
-                        threadlocals=True),
-    'mysql'      : MySQLDatabase(cf.dbname,
+                        threadlocals=True,
+                        **pool),
+    'mysql'      : PooledMySQLDatabase(cf.dbname,
                         user=cf.dbuser,
                         passwd=cf.dbpasswd,
                         host=cf.dbhost,
                         port=cf.dbport,
-                        threadlocals=True),
-    'sqlite'     : SqliteDatabase(cf.dbpath,
-                        threadlocals=True),
+                        threadlocals=True,
+                        **pool),
+    'sqlite'     : PooledSqliteDatabase(cf.dbpath,
+                        threadlocals=True,
+                        check_same_thread=False,
+                        **pool),
 }
 
 if cf.dbengine in engines:
@@ -43,14 +61,68 @@ class OTAPModel(Model):
 
 class Versioncheck(OTAPModel):
     imei            = CharField(null=False, max_length=15)
+    custid          = CharField(null=True, max_length=20)
     version         = CharField(null=True, max_length=10)
     tstamp          = DateTimeField(default=datetime.datetime.now, index=True)
     upgrade         = IntegerField(null=True)
 
+class Versionrollup(OTAPModel):
+    # Versioncheck rows counted per period (start of the hour or day) and
+    # imei/custid/version/upgrade; see owntracks/retention.py
+    period          = DateTimeField(null=False, index=True)
+    imei            = CharField(null=False, max_length=15)
+    custid          = CharField(null=True, max_length=20)
+    version         = CharField(null=True, max_length=10)
+    upgrade         = IntegerField(null=True)
+    count           = IntegerField(null=False, default=0)
+
+    class Meta:
+        indexes = (
+            (('imei', 'period'), False),
+            (('custid', 'period'), False),
+        )
+
+class Versionhourly(Versionrollup):
+    pass
+
+class Versiondaily(Versionrollup):
+    pass
+
+class Notifyevent(OTAPModel):
+    # OTAP results notified by devices; `version' is what they were to get
+    imei            = CharField(null=False, max_length=15)
+    custid          = CharField(null=True, max_length=20)
+    tid             = CharField(null=True, max_length=2)
+    device          = CharField(null=True, max_length=20)
+    version         = CharField(null=True, max_length=10)
+    result          = CharField(null=True, max_length=128)
+    ok              = IntegerField(null=True)
+    tstamp          = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        indexes = (
+            (('imei', 'tstamp'), False),
+            (('custid', 'tstamp'), False),
+            (('version', 'tstamp'), False),
+        )
+
 class Settings(OTAPModel):
     sname           = CharField(null=False, max_length=25, unique=True)
     settings        = TextField(null=True)
 
+class Settingslayer(OTAPModel):
+    # Settings for every device (scope 'global', name ''), the devices of
+    # a customer ('custid', <custid>) or a single device ('imei', <imei>).
+    # Together with the device's set they make up its effective settings.
+    scope           = CharField(null=False, max_length=10)
+    name            = CharField(null=False, max_length=20)
+    settings        = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            (('scope', 'name'), True),
+        )
+
 class Imeiset(OTAPModel):
     imei            = CharField(null=False, max_length=15, unique=True)
     sname           = CharField(null=False, max_length=25)
@@ -66,6 +138,7 @@ class Otap(OTAPModel):
     lastcheck       = DateTimeField(default=datetime.datetime.now, index=True)
     comment         = CharField(null=True, max_length=128)
     flags           = CharField(null=True, max_length=12)
+    sdigest         = CharField(null=True, max_length=40)   # of the settings last sent
 
     class Meta:
         indexes = (
@@ -73,20 +146,327 @@ class Otap(OTAPModel):
             # (('tst', ), True),
         )
 
+class Rollout(OTAPModel):
+    version         = CharField(null=False, max_length=10)
+    selector        = TextField(null=True)          # JSON, for display
+    devices         = IntegerField(null=False)
+    wavesize        = IntegerField(null=False)
+    waves           = IntegerField(null=False)
+    wave            = IntegerField(null=False, default=0)   # highest wave released
+    advance         = IntegerField(null=False, default=90)  # % successful before next wave
+    state           = CharField(null=False, max_length=10, default='active')
+    created         = DateTimeField(default=datetime.datetime.now)
+
+class Rolloutdevice(OTAPModel):
+    rollout         = IntegerField(null=False, index=True)
+    imei            = CharField(null=False, max_length=15, index=True)
+    wave            = IntegerField(null=False)
+    result          = CharField(null=True, max_length=10)   # None, 'ok' or 'failed'
+    saved           = CharField(null=True, max_length=10)   # deliver held back until its wave
+
+class Upgrade(OTAPModel):
+    # One row per attempt of a device to upgrade to `version', following it
+    # from versioncheck to notify; see owntracks/funnel.py
+    imei            = CharField(null=False, max_length=15)
+    custid          = CharField(null=True, max_length=20)
+    version         = CharField(null=False, max_length=10)
+    fromversion     = CharField(null=True, max_length=10)
+    state           = CharField(null=False, max_length=10)
+    offers          = IntegerField(null=False, default=0)
+    offered         = DateTimeField(null=True)
+    jad             = DateTimeField(null=True)
+    jar             = DateTimeField(null=True)
+    jarbytes        = BigIntegerField(null=False, default=0)
+    notified        = DateTimeField(null=True)
+    result          = CharField(null=True, max_length=64)
+
+    class Meta:
+        indexes = (
+            (('imei', 'state'), False),
+            (('version', 'offered'), False),
+        )
+
+class Fleetcounter(OTAPModel):
+    # See owntracks/fleetstats.py
+    custid          = CharField(null=False, max_length=20)
+    name            = CharField(null=False, max_length=40)
+    value           = IntegerField(null=False, default=0)
+
+    class Meta:
+        indexes = (
+            (('custid', 'name'), True),
+        )
+
+class Schemaversion(OTAPModel):
+    version         = IntegerField(null=False, unique=True)
+    description     = CharField(null=True, max_length=128)
+    applied         = DateTimeField(default=datetime.datetime.now)
+
 def createalltables():
 
     silent = True
 
-    db.connect()
+    dbconn()
+
+    try:
+        Otap.create_table(fail_silently=silent)
+        Versioncheck.create_table(fail_silently=silent)
+        Versionhourly.create_table(fail_silently=silent)
+        Versiondaily.create_table(fail_silently=silent)
+        Settings.create_table(fail_silently=silent)
+        Imeiset.create_table(fail_silently=silent)
+        Settingslayer.create_table(fail_silently=silent)
+        Rollout.create_table(fail_silently=silent)
+        Rolloutdevice.create_table(fail_silently=silent)
+        Fleetcounter.create_table(fail_silently=silent)
+        Upgrade.create_table(fail_silently=silent)
+        Notifyevent.create_table(fail_silently=silent)
+        Schemaversion.create_table(fail_silently=silent)
+
+        migrate()
+    finally:
+        # Don't keep a connection open across uWSGI's fork of the workers
+        dbclose()
 
-    Otap.create_table(fail_silently=silent)
-    Versioncheck.create_table(fail_silently=silent)
-    Settings.create_table(fail_silently=silent)
-    Imeiset.create_table(fail_silently=silent)
+# --- Migrations
+#
+# create_table() only creates what's missing, so changes to the schema of an
+# existing database are made by migrations. Each one is a function listed in
+# MIGRATIONS with the schema version it brings the database to; the versions
+# applied are recorded in the schemaversion table, and migrate() runs the
+# newer ones at startup. A migration checks for what it adds before adding it
+# (helpers below), so it is harmless when the table was just created with the
+# current models or when two otap.py instances start at the same time.
+# Append new migrations; never change or renumber one that has shipped.
+
+def quote(name):
+    return '{0}{1}{0}'.format(db.quote_char, name)
+
+def execute_autocommit(sql):
+    ''' Run `sql' outside of a transaction, as PostgreSQL requires for
+        CREATE/DROP INDEX CONCURRENTLY. peewee leaves psycopg2 in its default
+        mode, in which every statement starts a transaction implicitly. '''
+
+    conn = db.get_conn()
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(sql)
+    finally:
+        conn.autocommit = autocommit
+
+def pg_index_valid(name):
+    ''' True if PostgreSQL has a valid index `name', False if a failed
+        CREATE INDEX CONCURRENTLY left it INVALID, None if there is none '''
+
+    cursor = db.execute_sql("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s", (name,))
+    row = cursor.fetchone()
+    return None if row is None else bool(row[0])
+
+def add_index(model, columns, unique=False):
+    ''' Index `columns' of `model' unless the index exists. Where the engine
+        can, this doesn't block writes to the table while the index is
+        built: CREATE INDEX CONCURRENTLY on PostgreSQL, an in-place ALTER
+        TABLE on MySQL (InnoDB). Returns True if the index was created. '''
+
+    table = model._meta.db_table
+    name = '{0}_{1}'.format(table, '_'.join(columns))
+
+    if cf.dbengine == 'postgresql':
+        valid = pg_index_valid(name)
+        if valid:
+            return False
+        if valid is False:
+            # Left over from a concurrent build which failed; it is
+            # maintained on writes but never used, so build it again
+            log.info("Dropping invalid index {0} on {1}".format(name, table))
+            execute_autocommit("DROP INDEX CONCURRENTLY IF EXISTS {0}".format(quote(name)))
+    elif name in [i.name for i in db.get_indexes(table)]:
+        return False
+
+    params = {
+        'kind'      : 'UNIQUE INDEX' if unique else 'INDEX',
+        'name'      : quote(name),
+        'table'     : quote(table),
+        'columns'   : ', '.join(quote(c) for c in columns),
+    }
+
+    log.info("Creating index {0} on {1}".format(name, table))
+
+    if cf.dbengine == 'postgresql':
+        execute_autocommit("CREATE {kind} CONCURRENTLY {name} ON {table} ({columns})".format(**params))
+    elif cf.dbengine == 'mysql':
+        try:
+            db.execute_sql("ALTER TABLE {table} ADD {kind} {name} ({columns}), ALGORITHM=INPLACE, LOCK=NONE".format(**params))
+        except Exception, e:
+            # MySQL < 5.6 or a MyISAM table: the table is locked while we index
+            log.info("Cannot create index {0} online ({1}); locking {2}".format(name, str(e), table))
+            db.execute_sql("ALTER TABLE {table} ADD {kind} {name} ({columns})".format(**params))
+    else:
+        db.execute_sql("CREATE {kind} IF NOT EXISTS {name} ON {table} ({columns})".format(**params))
+
+    return True
+
+def add_column(model, name):
+    ''' Add the column for field `name' of `model' unless it exists. The
+        field must allow NULL or have a default. '''
+
+    table = model._meta.db_table
+    if name in [c.name for c in db.get_columns(table)]:
+        return False
+
+    log.info("Adding column {0} to {1}".format(name, table))
+    field = model._meta.fields[name]
+    migrations.migrate(SchemaMigrator.from_database(db).add_column(table, name, field))
+    return True
+
+def m001_indexes():
+    # find: tid or custid; imei: tid and custid
+    add_index(Otap, ['tid'])
+    add_index(Otap, ['custid', 'tid'])
+    # purge: count by deliver; fleet/rollout: by reported
+    add_index(Otap, ['deliver'])
+    add_index(Otap, ['reported'])
+    # imei_settings, s_undef, showsets: by sname
+    add_index(Imeiset, ['sname'])
+    # a device's versioncheck history
+    add_index(Versioncheck, ['imei', 'tstamp'])
+    # rollout progress
+    add_index(Rolloutdevice, ['rollout', 'wave'])
+
+def m002_versioncheck_custid():
+    # Rollups and statistics are kept per customer
+    add_column(Versioncheck, 'custid')
+    add_index(Versioncheck, ['custid', 'tstamp'])
+
+def m003_otap_sdigest():
+    # versioncheck only sends settings which changed since the last time
+    add_column(Otap, 'sdigest')
+
+def m004_rolloutdevice_saved():
+    # Devices of unreleased waves are held back; abort gives them back
+    # what they were delivered before
+    add_column(Rolloutdevice, 'saved')
+
+MIGRATIONS = [
+    (1, 'indexes for find, imei, purge, settings and versionlog', m001_indexes),
+    (2, 'custid in versioncheck', m002_versioncheck_custid),
+    (3, 'digest of the settings sent in otap', m003_otap_sdigest),
+    (4, 'deliver held back by a rollout', m004_rolloutdevice_saved),
+]
+
+def schemaversion():
+    return Schemaversion.select(fn.MAX(Schemaversion.version)).scalar() or 0
+
+def migrate():
+    ''' Bring the database schema up to the latest version '''
+
+    current = schemaversion()
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+
+        log.info("Migrating database schema to version {0}: {1}".format(version, description))
+        func()
+
+        try:
+            Schemaversion.create(version=version, description=description)
+        except IntegrityError:
+            # Another instance recorded it first
+            pass
+
+def explain(query):
+    ''' Return the database's plan for the peewee `query' as a list of dicts,
+        one per row of EXPLAIN (EXPLAIN QUERY PLAN on SQLite) '''
+
+    sql, params = query.sql()
+    prefix = 'EXPLAIN QUERY PLAN ' if cf.dbengine == 'sqlite' else 'EXPLAIN '
+
+    cursor = db.execute_sql(prefix + sql, params)
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+def uses_index(plan):
+    ''' True if no step of `plan' (see explain) reads a table without an
+        index. PostgreSQL prefers a sequential scan on small tables, so
+        there a False may only mean the table is small. '''
+
+    if cf.dbengine == 'sqlite':
+        for step in plan:
+            detail = str(step.get('detail', ''))
+            if (detail.startswith('SCAN') or detail.startswith('SEARCH')) and 'USING' not in detail:
+                return False
+        return True
+
+    if cf.dbengine == 'mysql':
+        for step in plan:
+            if step.get('table') is not None and step.get('key') is None:
+                return False
+        return True
+
+    return not any('Seq Scan' in str(v) for step in plan for v in step.values())
+
+def checkindexes(queries):
+    ''' EXPLAIN each of the peewee `queries' (a dict name -> query) and
+        return name -> {'index': uses_index, 'plan': [...]} '''
+
+    results = {}
+    for name, query in queries.iteritems():
+        try:
+            plan = explain(query)
+            results[name] = {
+                'index' : uses_index(plan),
+                'plan'  : [' '.join('{0}={1}'.format(k, v) for k, v in sorted(step.items())) for step in plan],
+            }
+        except Exception, e:
+            results[name] = { 'index' : None, 'plan' : [str(e)] }
+
+    return results
+
+# Errors which mean the database can't be used right now (it is down, the
+# connection broke, no pooled connection became free) rather than that
+# something is wrong with a statement. Writes failing with them are kept
+# and retried.
+TRANSIENT = (OperationalError, InterfaceError, MaxConnectionsExceeded)
+
+poolcounters = {
+    'checkouts'     : 0,
+    'errors'        : 0,
+}
 
 def dbconn():
-    # Attempt to connect if not already connected. For MySQL, take care of MySQL 2006
+    # Check a connection out of the pool for this thread unless it already
+    # has one. The pool verifies the connection first (MySQL 2006).
+    # Returns False if there is no connection.
+    if not db.is_closed():
+        return True
+
     try:
         db.connect()
+        poolcounters['checkouts'] += 1
     except Exception, e:
+        poolcounters['errors'] += 1
         log.info("Cannot connect to database: %s" % (str(e)))
+        return False
+    return True
+
+def dbclose():
+    # Return this thread's connection to the pool
+    if db.is_closed():
+        return
+
+    try:
+        db.close()
+    except Exception, e:
+        log.info("Cannot close database connection: %s" % (str(e)))
+
+def poolstats():
+    return {
+        'engine'        : cf.dbengine,
+        'max'           : db.max_connections,
+        'in_use'        : len(db._in_use),
+        'idle'          : len(db._connections),
+        'checkouts'     : poolcounters['checkouts'],
+        'errors'        : poolcounters['errors'],
+    }
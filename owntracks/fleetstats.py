@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import time
+import datetime
+import logging
+from owntracks.dbschema import db, dbconn, dbclose, Otap, Fleetcounter, IntegrityError
+from owntracks.writebehind import Flusher
+
+log = logging.getLogger(__name__)
+
+# Per customer we count, in Fleetcounter rows named
+#   devices             devices
+#   blocked             blocked devices
+#   pending             devices with a deliver version they don't report yet
+#   newest:<v>          devices to be delivered the newest JAR ('*') which
+#                       report version <v>; they are pending unless <v> is
+#                       the newest JAR when the counters are read
+#   version:<v>         devices reporting version <v> ('-' for none yet)
+#   seen:<hour>         devices whose lastcheck is in that UTC hour
+# Whoever changes a device tells FleetCounters its state before and after
+# (move()); changes made by set-based statements (fleet, rollouts, block
+# ALL) are announced with the statement's WHERE before it is run
+# (change()), and the devices it matches are read to find their states.
+# The differences are kept in memory and added to the rows every
+# `interval' seconds, so the counters of several processes add up.
+#
+# Changes can still be missed, e.g. when an UPDATE announced fails, or
+# counted twice when a process recounts while others hold changes which
+# are already in the otap table. Every `reconcile' seconds one process
+# recounts the counters from the otap table: the one which first moves the
+# time in the RECONCILED row forward.
+
+RECONCILED = '@reconciled'
+
+STALE = (
+    ('1h',  datetime.timedelta(hours=1)),
+    ('24h', datetime.timedelta(hours=24)),
+    ('7d',  datetime.timedelta(days=7)),
+)
+
+def hourkey(dt):
+    if dt is None:
+        return 'never'
+    if isinstance(dt, basestring):
+        return dt[:13]
+    return dt.strftime('%Y-%m-%d %H')
+
+def names(state):
+    ''' The counters a device with `state' (a dict with custid, reported,
+        deliver, block, lastcheck) contributes to '''
+
+    if state is None:
+        return []
+
+    n = ['devices', 'version:' + (state['reported'] or '-'), 'seen:' + hourkey(state['lastcheck'])]
+    if state['block']:
+        n.append('blocked')
+    if state['deliver'] == '*':
+        n.append('newest:' + (state['reported'] or '-'))
+    elif state['deliver'] is not None and state['deliver'] != state['reported']:
+        n.append('pending')
+    return n
+
+class FleetCounters(Flusher):
+
+    def __init__(self, interval=10, pending=None, latest=None, reconcile=3600):
+        Flusher.__init__(self, 'fleetstats', interval)
+
+        # pending(imei) returns column values not yet written to otap;
+        # latest() the version of the newest JAR
+        self.pending = pending or (lambda imei: {})
+        self.latest = latest or (lambda: None)
+        self.reconcile = reconcile
+        self.deltas = {}
+        self.checked = 0
+
+        self.flushes = 0
+        self.rebuilds = 0
+        self.failed = 0
+
+    def count(self, deltas, old, new):
+        for custid, counters, sign in ((old and old['custid'], names(old), -1), (new and new['custid'], names(new), 1)):
+            for name in counters:
+                key = (custid, name)
+                deltas[key] = deltas.get(key, 0) + sign
+
+    def move(self, old, new):
+        ''' Account for a device changing from state `old' to `new'; either
+            may be None for a device which is added or removed '''
+
+        self.start()
+
+        with self.lock:
+            self.count(self.deltas, old, new)
+
+    def change(self, where, **values):
+        ''' Account for setting the otap columns `values' (deliver, block)
+            on the devices matching `where' (all if None), which the caller
+            is about to do. Reads those devices. '''
+
+        self.start()
+
+        deltas = {}
+        for old in self.states(where):
+            self.count(deltas, old, dict(old, **values))
+
+        with self.lock:
+            for key, delta in deltas.iteritems():
+                self.deltas[key] = self.deltas.get(key, 0) + delta
+
+    def states(self, where=None):
+        ''' Yield the state of the devices matching `where' (all if None),
+            with the values not yet written to otap '''
+
+        query = Otap.select(Otap.imei, Otap.custid, Otap.reported, Otap.deliver, Otap.block, Otap.lastcheck)
+        if where is not None:
+            query = query.where(where)
+        for o in query.naive().iterator():
+            hb = self.pending(o.imei)
+            yield dict(custid=o.custid, reported=hb.get('reported', o.reported), deliver=o.deliver,
+                block=o.block, lastcheck=hb.get('lastcheck', o.lastcheck))
+
+    def flush(self):
+        with self.flushlock:
+            with self.lock:
+                deltas = dict((k, v) for k, v in self.deltas.iteritems() if v != 0)
+                self.deltas = {}
+
+            if deltas:
+                self.write(deltas)
+
+            if self.reconcile and time.time() - self.checked >= self.reconcile / 10.0:
+                self.checked = time.time()
+                dbconn()
+                try:
+                    if self.claim():
+                        self.rebuild()
+                except Exception, e:
+                    log.error("fleetstats: cannot reconcile counters: {0}".format(str(e)))
+                finally:
+                    dbclose()
+
+    def write(self, deltas):
+        dbconn()
+        try:
+            with db.transaction():
+                for (custid, name), delta in deltas.iteritems():
+                    self.add(custid, name, delta)
+                Fleetcounter.delete().where(Fleetcounter.value == 0).execute()
+            self.flushes += 1
+        except Exception, e:
+            self.failed += 1
+            log.error("fleetstats: cannot update counters: {0}".format(str(e)))
+
+            # Keep them for the next round
+            with self.lock:
+                for key, delta in deltas.iteritems():
+                    self.deltas[key] = self.deltas.get(key, 0) + delta
+        finally:
+            dbclose()
+
+    def add(self, custid, name, delta):
+        where = (Fleetcounter.custid == custid) & (Fleetcounter.name == name)
+        n = Fleetcounter.update(value=Fleetcounter.value + delta).where(where).execute()
+        if n == 0:
+            Fleetcounter.insert(custid=custid, name=name, value=delta).execute()
+
+    def claim(self):
+        ''' True if it is this process which is to reconcile the counters
+            now: the RECONCILED row holds the time they last were, and only
+            one process can move it forward '''
+
+        now = int(time.time())
+        where = (Fleetcounter.custid == '') & (Fleetcounter.name == RECONCILED)
+        if Fleetcounter.update(value=now).where(where & (Fleetcounter.value <= now - self.reconcile)).execute() == 1:
+            return True
+
+        try:
+            with db.transaction():
+                Fleetcounter.insert(custid='', name=RECONCILED, value=now).execute()
+        except IntegrityError:
+            # It exists, and the counters were reconciled recently
+            return False
+        return True
+
+    def rebuild(self):
+        ''' Recount everything from the otap table. Changes this process
+            collected so far are in the table (or pending) and are dropped.
+            Returns True if the counters were rebuilt. '''
+
+        with self.lock:
+            self.deltas = {}
+
+        dbconn()
+        try:
+            totals = {}
+            for state in self.states():
+                self.count(totals, None, state)
+
+            rows = [dict(custid=c, name=n, value=v) for (c, n), v in totals.iteritems()]
+            with db.transaction():
+                Fleetcounter.delete().where(Fleetcounter.name != RECONCILED).execute()
+                for n in range(0, len(rows), 200):
+                    Fleetcounter.insert_many(rows[n:n + 200]).execute()
+            self.rebuilds += 1
+            return True
+        except Exception, e:
+            self.failed += 1
+            log.error("fleetstats: cannot rebuild counters: {0}".format(str(e)))
+
+            # Let whoever looks next try again
+            try:
+                Fleetcounter.delete().where((Fleetcounter.custid == '') & (Fleetcounter.name == RECONCILED)).execute()
+            except Exception:
+                pass
+            return False
+        finally:
+            dbclose()
+
+    def seed(self):
+        ''' Build the counters if there are none yet, e.g. in a database
+            which existed before they were introduced '''
+
+        if not Fleetcounter.select().where(Fleetcounter.name != RECONCILED).exists() and Otap.select().exists():
+            self.rebuild()
+
+    def read(self, custid=None):
+        ''' Return a dict custid -> statistics, including changes not yet
+            written by this process '''
+
+        counters = {}
+        query = Fleetcounter.select()
+        if custid is not None:
+            query = query.where(Fleetcounter.custid == custid)
+        for c in query.naive():
+            counters[(c.custid, c.name)] = c.value
+
+        with self.lock:
+            for key, delta in self.deltas.iteritems():
+                if custid is None or key[0] == custid:
+                    counters[key] = counters.get(key, 0) + delta
+
+        latest = self.latest()
+        now = datetime.datetime.utcnow()
+        stats = {}
+        for (c, name), value in counters.iteritems():
+            if value == 0 or name.startswith('@'):
+                continue
+
+            s = stats.setdefault(c, {
+                'devices'   : 0,
+                'blocked'   : 0,
+                'pending'   : 0,
+                'versions'  : {},
+                'silent'    : dict([(label, 0) for label, age in STALE] + [('never', 0)]),
+            })
+
+            if name in ('devices', 'blocked', 'pending'):
+                s[name] += value
+            elif name.startswith('newest:'):
+                if latest is not None and name[7:] != latest:
+                    s['pending'] += value
+            elif name.startswith('version:'):
+                s['versions'][name[8:]] = value
+            elif name == 'seen:never':
+                s['silent']['never'] += value
+            elif name.startswith('seen:'):
+                try:
+                    seen = datetime.datetime.strptime(name[5:], '%Y-%m-%d %H') + datetime.timedelta(hours=1)
+                except ValueError:
+                    continue
+                for label, age in STALE:
+                    if now - seen >= age:
+                        s['silent'][label] += value
+
+        return stats
+
+    def stats(self):
+        with self.lock:
+            queued = len(self.deltas)
+
+        return {
+            'queued'    : queued,
+            'flushes'   : self.flushes,
+            'rebuilds'  : self.rebuilds,
+            'failed'    : self.failed,
+        }
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import datetime
+import logging
+from owntracks.dbschema import db, dbconn, dbclose, fn, Upgrade, TRANSIENT
+from owntracks.writebehind import Flusher
+from owntracks.rollout import succeeded
+
+log = logging.getLogger(__name__)
+
+# An upgrade goes through these stages, each recorded with its time in the
+# column of the same name:
+#   offered     versioncheck answered upgrade=1 (offers counts how often)
+#   jad         the device fetched otap.jad
+#   jar         the device fetched the JAR (jarbytes adds up what was sent)
+#   notified    the device notified its result; state becomes done or failed
+# A device has at most one open upgrade; when it is offered a different
+# version, the open one is abandoned. The stages arrive at different
+# endpoints (and possibly workers) and are tied together by IMEI. Events
+# are queued in order and written by a background thread; while the
+# database is unavailable they stay queued.
+
+OPEN = ('offered', 'jad', 'jar')
+
+class Funnel(Flusher):
+
+    def __init__(self, interval=5, maxqueue=10000):
+        Flusher.__init__(self, 'funnel', interval)
+
+        self.maxqueue = maxqueue
+        self.queue = []
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+
+    def event(self, *event):
+        self.start()
+
+        with self.lock:
+            if len(self.queue) >= self.maxqueue:
+                self.dropped += 1
+                return
+            self.queue.append(event + (datetime.datetime.utcnow().replace(microsecond=0),))
+
+    def offer(self, imei, custid, version, fromversion):
+        self.event('offer', imei, custid, version, fromversion)
+
+    def jad(self, imei, custid, version):
+        self.event('jad', imei, custid, version)
+
+    def jar(self, imei, version, octets):
+        self.event('jar', imei, version, octets)
+
+    def notify(self, imei, result):
+        self.event('notify', imei, result)
+
+    def flush(self):
+        with self.flushlock:
+            with self.lock:
+                events = self.queue
+                self.queue = []
+            if not events:
+                return
+
+            dbconn()
+            try:
+                with db.transaction():
+                    for event in events:
+                        getattr(self, 'apply_' + event[0])(*event[1:])
+                self.written += len(events)
+            except TRANSIENT, e:
+                with self.lock:
+                    self.queue[:0] = events
+                    excess = len(self.queue) - self.maxqueue
+                    if excess > 0:
+                        del self.queue[-excess:]
+                        self.dropped += excess
+                self.retried += len(events)
+                log.error("funnel: cannot record {0} events; keeping them: {1}".format(len(events), str(e)))
+            except Exception, e:
+                self.failed += len(events)
+                log.error("funnel: cannot record {0} events: {1}".format(len(events), str(e)))
+            finally:
+                dbclose()
+
+    def opened(self, imei, version=None):
+        where = (Upgrade.imei == imei) & (Upgrade.state << list(OPEN))
+        if version is not None:
+            where = where & (Upgrade.version == version)
+        return where
+
+    def apply_offer(self, imei, custid, version, fromversion, ts):
+        n = Upgrade.update(offers=Upgrade.offers + 1).where(self.opened(imei, version)).execute()
+        if n == 0:
+            Upgrade.update(state='abandoned').where(self.opened(imei)).execute()
+            Upgrade.insert(imei=imei, custid=custid, version=version, fromversion=fromversion,
+                state='offered', offers=1, offered=ts).execute()
+
+    def apply_jad(self, imei, custid, version, ts):
+        n = (Upgrade.update(jad=fn.COALESCE(Upgrade.jad, ts))
+            .where(self.opened(imei, version))
+            .execute())
+        if n == 0:
+            # Fetched without a versioncheck (e.g. started by hand)
+            Upgrade.update(state='abandoned').where(self.opened(imei)).execute()
+            Upgrade.insert(imei=imei, custid=custid, version=version, state='jad', jad=ts).execute()
+        else:
+            Upgrade.update(state='jad').where(self.opened(imei, version) & (Upgrade.state == 'offered')).execute()
+
+    def apply_jar(self, imei, version, octets, ts):
+        (Upgrade.update(jar=fn.COALESCE(Upgrade.jar, ts), jarbytes=Upgrade.jarbytes + octets, state='jar')
+            .where(self.opened(imei, version))
+            .execute())
+
+    def apply_notify(self, imei, result, ts):
+        state = 'done' if succeeded(result) else 'failed'
+        Upgrade.update(notified=ts, result=result[:64], state=state).where(self.opened(imei)).execute()
+
+    def stats(self):
+        with self.lock:
+            queued = len(self.queue)
+
+        return {
+            'queued'    : queued,
+            'written'   : self.written,
+            'dropped'   : self.dropped,
+            'failed'    : self.failed,
+            'retried'   : self.retried,
+        }
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = int(round((len(values) - 1) * p / 100.0))
+    return values[k]
+
+def report(version=None, custid=None, since=None):
+    ''' Return per version the number of upgrades which reached each stage,
+        the conversion from each stage to the next, the JAR bytes sent
+        (in total and per successful upgrade) and the 50th/90th/99th
+        percentile of the seconds from first offer to successful notify. '''
+
+    query = Upgrade.select(Upgrade.version, Upgrade.state, Upgrade.offered, Upgrade.jad,
+        Upgrade.jar, Upgrade.jarbytes, Upgrade.notified)
+    if version is not None:
+        query = query.where(Upgrade.version == version)
+    if custid is not None:
+        query = query.where(Upgrade.custid == custid)
+    if since is not None:
+        query = query.where((Upgrade.offered >= since) | ((Upgrade.offered >> None) & (Upgrade.jad >= since)))
+
+    versions = {}
+    for u in query.naive().iterator():
+        v = versions.setdefault(u.version, {
+            'offered'   : 0,
+            'jad'       : 0,
+            'jar'       : 0,
+            'done'      : 0,
+            'failed'    : 0,
+            'abandoned' : 0,
+            'open'      : 0,
+            'bytes'     : 0,
+            'seconds'   : [],
+        })
+
+        v['offered'] += 1 if u.offered is not None else 0
+        v['jad'] += 1 if u.jad is not None else 0
+        v['jar'] += 1 if u.jar is not None else 0
+        v['bytes'] += u.jarbytes or 0
+        if u.state in OPEN:
+            v['open'] += 1
+        else:
+            v[u.state] += 1
+
+        start = u.offered or u.jad
+        if u.state == 'done' and start is not None and u.notified is not None:
+            v['seconds'].append((u.notified - start).total_seconds())
+
+    def rate(a, b):
+        return round(float(b) / a, 3) if a else None
+
+    for v in versions.itervalues():
+        seconds = v.pop('seconds')
+        v['conversion'] = {
+            'offered_jad'   : rate(v['offered'], v['jad']),
+            'jad_jar'       : rate(v['jad'], v['jar']),
+            'jar_done'      : rate(v['jar'], v['done']),
+            'offered_done'  : rate(v['offered'], v['done']),
+        }
+        v['bytes_per_upgrade'] = v['bytes'] // v['done'] if v['done'] else None
+        v['time_to_upgrade'] = {
+            'p50'   : percentile(seconds, 50),
+            'p90'   : percentile(seconds, 90),
+            'p99'   : percentile(seconds, 99),
+        }
+
+    return versions
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import os
+import mmap
+import fcntl
+import struct
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+# A generation counter is bumped whenever data which processes cache is
+# changed; a cache which sees a different generation than the one it was
+# filled in drops its contents.
+
+class Generation(object):
+    ''' A generation counter for a single process '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def current(self):
+        return self.value
+
+    def bump(self):
+        with self.lock:
+            self.value += 1
+            return self.value
+
+class SharedGeneration(object):
+    ''' A generation counter kept in the file at `path' and mapped into
+        memory, so that all uWSGI workers on a host see each other's bumps
+        and reading it costs no system call. Bumps are serialized with
+        flock(2). '''
+
+    FORMAT = '<Q'
+
+    def __init__(self, path):
+        self.path = path
+        self.size = struct.calcsize(self.FORMAT)
+        self.lock = threading.Lock()
+        self.fd = None
+        self.map = None
+
+    def open(self):
+        if self.map is None:
+            with self.lock:
+                if self.map is None:
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+                    if os.fstat(fd).st_size < self.size:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                        try:
+                            if os.fstat(fd).st_size < self.size:
+                                os.ftruncate(fd, self.size)
+                        finally:
+                            fcntl.flock(fd, fcntl.LOCK_UN)
+                    self.fd = fd
+                    self.map = mmap.mmap(fd, self.size)
+        return self.map
+
+    def current(self):
+        return struct.unpack(self.FORMAT, self.open()[0:self.size])[0]
+
+    def bump(self):
+        m = self.open()
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                value = struct.unpack(self.FORMAT, m[0:self.size])[0] + 1
+                m[0:self.size] = struct.pack(self.FORMAT, value)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return value
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import os
+import re
+import hashlib
+import time
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+def version_key(version):
+    ''' Sort key for a JAR version string. Versions StrictVersion understands
+        (0.10.65, 1.2, 1.2b3) sort the way it sorts them; anything else (e.g.
+        0.10.65-test) is split into numeric and alphabetic parts rather than
+        raising. A suffix sorts before the plain version, like a pre-release. '''
+
+    m = re.match(r'^(\d+(?:\.\d+)*)(.*)$', version)
+    if m is None:
+        return ((), 0, tuple(re.findall(r'\d+|[A-Za-z]+', version)))
+
+    numbers = tuple(int(n) for n in m.group(1).split('.'))
+    numbers = numbers + (0,) * (3 - len(numbers))
+
+    suffix = m.group(2)
+    if not suffix:
+        return (numbers, 1, ())
+
+    parts = tuple(int(p) if p.isdigit() else p for p in re.findall(r'\d+|[A-Za-z]+', suffix))
+    return (numbers, 0, parts)
+
+class JarIndex(object):
+    ''' In-process index of the JAR files in `jardir'. For each version it
+        holds the parsed sort key, the path, the size and the mtime of the
+        file. The directory is rescanned only when its mtime changes (checked
+        at most every `recheck' seconds) or when invalidate() is called, so
+        a JAR must be replaced by renaming a new file over it, as jarupload
+        does: rewriting it in place doesn't change the directory. '''
+
+    def __init__(self, jardir, recheck=1):
+        self.jardir = jardir
+        self.recheck = recheck
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.versions = []
+        self.dirmtime = None
+        self.checked = 0
+        self.scans = 0
+
+    def invalidate(self):
+        ''' Force a rescan on next use; call after adding or removing a JAR '''
+
+        with self.lock:
+            self.dirmtime = None
+            self.checked = 0
+
+    def refresh(self):
+        now = time.time()
+        if self.dirmtime is not None and now - self.checked < self.recheck:
+            return
+
+        with self.lock:
+            try:
+                dirmtime = os.stat(self.jardir).st_mtime
+            except OSError:
+                dirmtime = 0
+
+            self.checked = now
+            if dirmtime == self.dirmtime:
+                return
+
+            self.scan()
+            self.dirmtime = dirmtime
+
+    def scan(self):
+        entries = {}
+        try:
+            files = os.listdir(self.jardir)
+        except OSError, e:
+            log.error("Cannot list {0}: {1}".format(self.jardir, str(e)))
+            files = []
+
+        for f in files:
+            if f.startswith('.'):
+                continue
+            path = os.path.join(self.jardir, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path):
+                continue
+
+            version = f.replace('.jar', '')
+            entries[version] = {
+                'version'   : version,
+                'key'       : version_key(version),
+                'path'      : path,
+                'size'      : st.st_size,
+                'mtime'     : st.st_mtime,
+            }
+
+        self.entries = entries
+        self.versions = sorted(entries, key=lambda v: entries[v]['key'])
+        self.scans += 1
+
+    def list(self):
+        ''' Return the sorted list of versions '''
+
+        self.refresh()
+        return list(self.versions)
+
+    def latest(self):
+        ''' Return the highest version or None if there are no JARs '''
+
+        self.refresh()
+        if not self.versions:
+            return None
+        return self.versions[-1]
+
+    def get(self, version):
+        ''' Return the entry for `version' or None if there is no such JAR '''
+
+        self.refresh()
+        return self.entries.get(version)
+
+    def etag(self, version):
+        ''' Return a strong entity tag for `version': the SHA1 of the JAR's
+            content. It is computed once and recomputed only when the file's
+            size or mtime change. '''
+
+        entry = self.get(version)
+        if entry is None:
+            return None
+
+        st = os.stat(entry['path'])
+        stamp = (st.st_size, st.st_mtime)
+
+        cached = entry.get('etag')
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        sha = hashlib.sha1()
+        with open(entry['path'], 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha.update(block)
+
+        etag = sha.hexdigest()
+        entry['etag'] = (stamp, etag)
+        return etag
+
+    def stats(self):
+        return {
+            'versions'  : len(self.versions),
+            'scans'     : self.scans,
+        }
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+class NonceCache(object):
+    ''' Remember the nonces of RPC tokens seen in the last `window' seconds
+        so that a token can't be used twice. Nonces are only forgotten once
+        they are older than that; while `maxsize' are held, new tokens are
+        refused rather than making room, which would allow replays. '''
+
+    def __init__(self, window=300, maxsize=100000):
+        self.window = window
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.nonces = OrderedDict()
+        self.replays = 0
+        self.refused = 0
+
+    def seen(self, nonce):
+        ''' Record `nonce' and return True if it had already been used or
+            can't be recorded '''
+
+        now = time.time()
+        with self.lock:
+            while self.nonces:
+                first, tstamp = next(self.nonces.iteritems())
+                if tstamp >= now - self.window:
+                    break
+                del self.nonces[first]
+
+            if nonce in self.nonces:
+                self.replays += 1
+                return True
+
+            if len(self.nonces) >= self.maxsize:
+                self.refused += 1
+                log.error("Nonce cache full ({0} tokens in {1}s); refusing token".format(self.maxsize, self.window))
+                return True
+
+            self.nonces[nonce] = now
+            return False
+
+    def stats(self):
+        return {
+            'nonces'    : len(self.nonces),
+            'replays'   : self.replays,
+            'refused'   : self.refused,
+        }
+
+class SharedNonceCache(object):
+    ''' Like NonceCache, but kept in an SQLite file at `path' so that all
+        uWSGI workers on a host share it. The primary key makes the check
+        and the insert a single statement. '''
+
+    def __init__(self, path, window=300, purgeevery=1000):
+        self.path = path
+        self.window = window
+        self.purgeevery = purgeevery
+        self.lock = threading.Lock()
+        self.conn = None
+        self.inserts = 0
+        self.replays = 0
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS nonces (nonce TEXT PRIMARY KEY, tstamp REAL)")
+            self.conn.commit()
+        return self.conn
+
+    def seen(self, nonce):
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            try:
+                with conn:
+                    conn.execute("INSERT INTO nonces (nonce, tstamp) VALUES (?, ?)", (nonce, now))
+            except sqlite3.IntegrityError:
+                self.replays += 1
+                return True
+
+            self.inserts += 1
+            if self.inserts % self.purgeevery == 0:
+                with conn:
+                    conn.execute("DELETE FROM nonces WHERE tstamp < ?", (now - self.window,))
+
+            return False
+
+    def stats(self):
+        return {
+            'path'      : self.path,
+            'replays'   : self.replays,
+        }
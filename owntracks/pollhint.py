@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import time
+import zlib
+import threading
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+
+class RateMeter(object):
+    ''' Count events in one-second buckets over the last `window' seconds '''
+
+    def __init__(self, window=60):
+        self.window = window
+        self.lock = threading.Lock()
+        self.buckets = collections.deque()     # [second, count]
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+
+    def hit(self):
+        now = int(time.time())
+        with self.lock:
+            self.expire(now)
+            if self.buckets and self.buckets[-1][0] == now:
+                self.buckets[-1][1] += 1
+            else:
+                self.buckets.append([now, 1])
+
+    def rate(self):
+        ''' Events per second, averaged over the window '''
+
+        with self.lock:
+            self.expire(int(time.time()))
+            return sum(count for second, count in self.buckets) / float(self.window)
+
+class PollHint(object):
+    ''' Compute the versionInterval to hand to a device. While this process
+        sees at most `target' versionchecks per second, devices get `base'
+        seconds; above that the interval grows in proportion to the load.
+        It is spread by up to +/- `jitter' (a fraction), rounded to
+        `step' seconds and clamped to [floor, ceiling].
+
+        The jitter is derived from the IMEI rather than drawn at random:
+        each device keeps getting the same interval while the load doesn't
+        change, so its settings aren't rewritten on every poll, but devices
+        which poll in lockstep drift apart. `overrides' maps a custid to a
+        dict with any of base, floor, ceiling for that customer. '''
+
+    def __init__(self, meter, base=10800, floor=3600, ceiling=43200, target=5.0,
+                jitter=0.2, step=60, overrides=None):
+        self.meter = meter
+        self.base = base
+        self.floor = floor
+        self.ceiling = ceiling
+        self.target = target
+        self.jitter = jitter
+        self.step = max(1, step)
+        # Per-customer parameters by lower-cased custid: ConfigParser
+        # lower-cases option names, so [pollhints] keys come that way
+        self.overrides = dict((k.lower(), v) for k, v in (overrides or {}).iteritems())
+
+    def load(self):
+        ''' Return the factor by which intervals are stretched, at least 1.
+            It moves in steps of 0.5 so that small changes in the request
+            rate don't change every device's interval. '''
+
+        if not self.target:
+            return 1.0
+        return max(1.0, round(self.meter.rate() / self.target * 2) / 2.0)
+
+    def interval(self, imei, custid=None):
+        params = self.overrides.get((custid or '').lower()) or {}
+        base = params.get('base', self.base)
+        floor = params.get('floor', self.floor)
+        ceiling = params.get('ceiling', self.ceiling)
+
+        seconds = base * self.load()
+
+        # A fraction in [-1, 1), fixed per IMEI
+        spread = (zlib.crc32(imei) & 0xffff) / 32768.0 - 1.0
+        seconds = seconds * (1.0 + self.jitter * spread)
+
+        seconds = round(seconds / self.step) * self.step
+        return int(min(max(seconds, floor), ceiling))
+
+    def stats(self):
+        return {
+            'rate'      : round(self.meter.rate(), 2),
+            'load'      : round(self.load(), 2),
+        }
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import os
+import json
+import collections
+import logging
+import paho.mqtt.client as paho
+from owntracks.writebehind import Flusher
+
+log = logging.getLogger(__name__)
+
+class Publisher(Flusher):
+    ''' A long-lived MQTT connection for notifications. put() only queues
+        the message; a background thread publishes queued messages in
+        batches of `batchsize'. paho reconnects with exponential backoff
+        when the broker goes away. When more than `maxqueue' messages are
+        waiting, new ones are dropped or, with policy 'spool', appended to
+        the file `spool' and published once the broker is back. '''
+
+    def __init__(self, hostname='localhost', port=1883, maxqueue=1000, batchsize=100,
+                policy='drop', spool=None, interval=1):
+        Flusher.__init__(self, 'mqtt-publisher', interval)
+
+        self.hostname = hostname
+        self.port = port
+        self.maxqueue = maxqueue
+        self.batchsize = batchsize
+        self.policy = policy
+        self.spool = spool
+        self.queue = collections.deque()
+        self.client = None
+        self.connected = False
+
+        self.published = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.failed = 0
+        self.connects = 0
+
+    def put(self, topic, payload):
+        self.start()
+
+        with self.lock:
+            if len(self.queue) >= self.maxqueue:
+                if self.policy == 'spool' and self.spool is not None:
+                    self.spoolwrite([(topic, payload)])
+                else:
+                    self.dropped += 1
+                    if self.dropped % 100 == 1:
+                        log.warning("MQTT queue full; {0} messages dropped so far".format(self.dropped))
+                return
+
+            self.queue.append((topic, payload))
+
+        self.wakeup.set()
+
+    def connect(self):
+        ''' Create the client and start its network thread. paho retries
+            the connection itself, so this only happens once per process. '''
+
+        if self.client is not None:
+            return
+
+        self.client = paho.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        if hasattr(self.client, 'reconnect_delay_set'):
+            self.client.reconnect_delay_set(1, 120)
+        self.client.connect_async(self.hostname, self.port, 60)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connected = True
+            self.connects += 1
+            self.wakeup.set()
+        else:
+            log.error("MQTT connection to {0}:{1} refused: rc={2}".format(self.hostname, self.port, rc))
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            log.error("MQTT connection to {0}:{1} lost: rc={2}".format(self.hostname, self.port, rc))
+
+    def flush(self):
+        with self.flushlock:
+            if self.client is None and not self.queue:
+                return
+
+            self.connect()
+            if not self.connected:
+                return
+
+            self.spoolread()
+
+            while self.connected:
+                with self.lock:
+                    batch = [self.queue.popleft() for n in range(min(self.batchsize, len(self.queue)))]
+                if not batch:
+                    break
+
+                for n, (topic, payload) in enumerate(batch):
+                    try:
+                        info = self.client.publish(topic, payload, qos=1, retain=False)
+                        rc = info[0]
+                    except Exception, e:
+                        log.error("Cannot MQTT publish: {0}".format(str(e)))
+                        rc = -1
+
+                    if rc != paho.MQTT_ERR_SUCCESS:
+                        # Put the rest back and wait for paho to reconnect
+                        self.failed += 1
+                        with self.lock:
+                            self.queue.extendleft(reversed(batch[n:]))
+                        return
+
+                    self.published += 1
+
+    def spoolwrite(self, messages):
+        try:
+            with open(self.spool, 'a') as f:
+                for topic, payload in messages:
+                    f.write(json.dumps([topic, payload]) + "\n")
+            self.spooled += len(messages)
+        except Exception, e:
+            self.dropped += len(messages)
+            log.error("Cannot spool MQTT messages to {0}: {1}".format(self.spool, str(e)))
+
+    def spoolread(self):
+        ''' Move spooled messages back to the head of the queue, as many as fit '''
+
+        if self.spool is None or not os.path.exists(self.spool):
+            return
+
+        with self.lock:
+            try:
+                with open(self.spool) as f:
+                    messages = [json.loads(line) for line in f if line.strip()]
+                os.remove(self.spool)
+            except Exception, e:
+                log.error("Cannot read MQTT spool {0}: {1}".format(self.spool, str(e)))
+                return
+
+            # Spooled messages are older than anything queued; send them first
+            room = max(0, self.maxqueue - len(self.queue))
+            self.queue.extendleft(reversed([(topic, payload) for topic, payload in messages[:room]]))
+            if messages[room:]:
+                self.spoolwrite(messages[room:])
+
+    def shutdown(self):
+        Flusher.shutdown(self)
+
+        with self.lock:
+            left = list(self.queue)
+            self.queue.clear()
+        if left:
+            if self.policy == 'spool' and self.spool is not None:
+                self.spoolwrite(left)
+            else:
+                self.dropped += len(left)
+                log.error("{0} MQTT messages not published at shutdown".format(len(left)))
+
+        if self.client is not None:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def stats(self):
+        with self.lock:
+            queued = len(self.queue)
+
+        return {
+            'connected' : self.connected,
+            'queued'    : queued,
+            'published' : self.published,
+            'dropped'   : self.dropped,
+            'spooled'   : self.spooled,
+            'failed'    : self.failed,
+            'connects'  : self.connects,
+        }
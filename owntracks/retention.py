@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import datetime
+import logging
+from owntracks.dbschema import db, dbconn, dbclose, fn, Versioncheck, Versionhourly, Versiondaily
+from owntracks.writebehind import Flusher, MAXPARAMS
+
+log = logging.getLogger(__name__)
+
+# Versioncheck rows older than `raw' days are counted into Versionhourly and
+# deleted, Versionhourly rows older than `hourly' days into Versiondaily, and
+# Versiondaily rows older than `daily' days are deleted. None keeps a level
+# for ever. Rows are moved `chunk' (at most MAXPARAMS) at a time, each chunk
+# in a transaction of its own, so that no long-running statement locks the
+# table. A chunk's rows are deleted first and only counted if all of them
+# were deleted by us: when two workers prune at the same time, the second
+# one's DELETE finds nothing and it rolls back instead of counting the rows
+# a second time.
+
+def hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def day(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+class Retention(Flusher):
+
+    def __init__(self, raw=None, hourly=None, daily=None, chunk=500, interval=3600):
+        Flusher.__init__(self, 'retention', interval)
+
+        self.raw = raw
+        self.hourly = hourly
+        self.daily = daily
+        self.chunk = max(1, min(chunk, MAXPARAMS))
+
+        self.passes = 0
+        self.rolled = 0
+        self.deleted = 0
+        self.conflicts = 0
+        self.failed = 0
+
+    def enabled(self):
+        return any(d is not None for d in (self.raw, self.hourly, self.daily))
+
+    def flush(self):
+        ''' Run one retention pass; returns a dict of rows moved per level '''
+
+        with self.flushlock:
+            now = datetime.datetime.utcnow()
+            done = {}
+
+            dbconn()
+            try:
+                if self.raw is not None:
+                    cutoff = hour(now - datetime.timedelta(days=self.raw))
+                    done['raw'] = self.rollup(Versioncheck, Versioncheck.tstamp, Versionhourly, hour, cutoff)
+                if self.hourly is not None:
+                    cutoff = day(now - datetime.timedelta(days=self.hourly))
+                    done['hourly'] = self.rollup(Versionhourly, Versionhourly.period, Versiondaily, day, cutoff)
+                if self.daily is not None:
+                    cutoff = day(now - datetime.timedelta(days=self.daily))
+                    done['daily'] = self.prune(Versiondaily, Versiondaily.period, cutoff)
+                self.passes += 1
+            except Exception, e:
+                self.failed += 1
+                log.error("retention: pass failed: {0}".format(str(e)))
+            finally:
+                dbclose()
+
+            return done
+
+    def rollup(self, source, timefield, target, truncate, cutoff):
+        ''' Move rows of `source' older than `cutoff' into `target', adding
+            them up per truncate(time)/imei/custid/version/upgrade '''
+
+        moved = 0
+        while not self.stopping:
+            rows = list(source.select().where(timefield < cutoff).order_by(source.id).limit(self.chunk).naive())
+            if not rows:
+                break
+
+            counts = {}
+            for r in rows:
+                period = truncate(getattr(r, timefield.name))
+                key = (period, r.imei, r.custid, r.version, r.upgrade)
+                counts[key] = counts.get(key, 0) + (1 if source is Versioncheck else r.count)
+
+            ids = [r.id for r in rows]
+            with db.transaction() as txn:
+                n = source.delete().where(source.id << ids).execute()
+                if n != len(ids):
+                    # Someone else is moving these rows
+                    txn.rollback()
+                    self.conflicts += 1
+                    break
+
+                for (period, imei, custid, version, upgrade), count in counts.iteritems():
+                    self.add(target, period, imei, custid, version, upgrade, count)
+
+            moved += len(ids)
+            self.rolled += len(ids)
+
+        return moved
+
+    def add(self, target, period, imei, custid, version, upgrade, count):
+        ''' Add `count' to the matching row of `target', creating it if needed '''
+
+        where = ((target.period == period) & (target.imei == imei)
+            & self.match(target.custid, custid) & self.match(target.version, version)
+            & self.match(target.upgrade, upgrade))
+
+        n = target.update(count=target.count + count).where(where).execute()
+        if n == 0:
+            target.insert(period=period, imei=imei, custid=custid, version=version, upgrade=upgrade, count=count).execute()
+
+    def match(self, field, value):
+        if value is None:
+            return field >> None
+        return field == value
+
+    def prune(self, model, timefield, cutoff):
+        deleted = 0
+        while not self.stopping:
+            ids = [r.id for r in model.select(model.id).where(timefield < cutoff).limit(self.chunk).naive()]
+            if not ids:
+                break
+
+            deleted += model.delete().where(model.id << ids).execute()
+        self.deleted += deleted
+        return deleted
+
+    def shutdown(self):
+        # Don't hold up process exit with a pass; the next one catches up
+        self.stopping = True
+        self.wakeup.set()
+
+    def stats(self):
+        return {
+            'passes'    : self.passes,
+            'rolled'    : self.rolled,
+            'deleted'   : self.deleted,
+            'conflicts' : self.conflicts,
+            'failed'    : self.failed,
+        }
+
+def history(imei=None, custid=None, since=None):
+    ''' Return the versionchecks since `since' (a UTC datetime) for `imei'
+        and/or `custid' from the raw log and both rollups together, as a
+        list of dicts (period, imei, custid, version, upgrade, count) sorted
+        by time. Raw rows have a count of 1 and their own timestamp. '''
+
+    results = []
+    for model, timefield in ((Versiondaily, Versiondaily.period), (Versionhourly, Versionhourly.period), (Versioncheck, Versioncheck.tstamp)):
+        query = model.select()
+        if imei is not None:
+            query = query.where(model.imei == imei)
+        if custid is not None:
+            query = query.where(model.custid == custid)
+        if since is not None:
+            query = query.where(timefield >= since)
+
+        for r in query.order_by(timefield).naive():
+            results.append({
+                'period'    : getattr(r, timefield.name),
+                'imei'      : r.imei,
+                'custid'    : r.custid,
+                'version'   : r.version,
+                'upgrade'   : r.upgrade,
+                'count'     : 1 if model is Versioncheck else r.count,
+            })
+
+    results.sort(key=lambda r: r['period'])
+    return results
+
+def counts(imei=None, custid=None, since=None):
+    ''' Return the number of versionchecks per (version, upgrade) since
+        `since' over the raw log and the rollups, as a list of dicts '''
+
+    totals = {}
+    for model, timefield, counter in (
+            (Versiondaily, Versiondaily.period, fn.SUM(Versiondaily.count)),
+            (Versionhourly, Versionhourly.period, fn.SUM(Versionhourly.count)),
+            (Versioncheck, Versioncheck.tstamp, fn.COUNT(Versioncheck.id))):
+        query = model.select(model.version, model.upgrade, counter.alias('n'))
+        if imei is not None:
+            query = query.where(model.imei == imei)
+        if custid is not None:
+            query = query.where(model.custid == custid)
+        if since is not None:
+            query = query.where(timefield >= since)
+        query = query.group_by(model.version, model.upgrade)
+
+        for r in query.naive():
+            key = (r.version, r.upgrade)
+            totals[key] = totals.get(key, 0) + int(r.n or 0)
+
+    return [dict(version=v, upgrade=u, count=n) for (v, u), n in sorted(totals.items())]
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import json
+import math
+import random
+import logging
+from owntracks.dbschema import db, dbconn, dbclose, Otap, Rollout, Rolloutdevice
+from owntracks.writebehind import WriteBehind
+
+log = logging.getLogger(__name__)
+
+# Keep multi-row INSERTs below SQLite's default limit of 999 host parameters
+CHUNK = 300
+
+# The FleetCounters told about the deliver versions rollouts set, if any
+counters = None
+
+def deliver(where, version):
+    ''' Set deliver to `version' on the devices matching `where' '''
+
+    if counters is not None:
+        counters.change(where, deliver=version)
+    return Otap.update(deliver=version).where(where).execute()
+
+# A staged rollout releases a version to its cohort in waves. Devices of
+# released waves get Otap.deliver set to the version, so versioncheck and
+# otap.jad treat them as they always have. Devices of later waves have
+# deliver cleared until their wave, as whatever it was ('*' or even the
+# version itself) would upgrade them at once; abort gives them back what
+# they had, kept in Rolloutdevice.saved. The next wave is released when
+# `advance' percent of the devices released so far have notified a
+# successful upgrade; when so many have failed that this can no longer
+# happen, the rollout is paused.
+
+def succeeded(result):
+    ''' True if the body of an OTAP notify reports success. Devices send
+        the MIDP install status, e.g. "900 Success". '''
+
+    return result.strip().startswith('900')
+
+def start(version, where, selector, wavesize=0, percent=0, advance=90):
+    ''' Create a rollout of `version' to the devices matching `where', split
+        into waves of `wavesize' devices or `percent' percent of the cohort,
+        and release the first wave, holding back the others. Devices which
+        are blocked or already report `version' are left out. Returns the
+        Rollout or None if the cohort is empty. '''
+
+    query = (Otap.select(Otap.imei, Otap.deliver)
+        .where(where & (Otap.block == 0) & ((Otap.reported >> None) | (Otap.reported != version))))
+    delivers = dict((o.imei, o.deliver) for o in query.naive())
+    imeis = list(delivers)
+    if not imeis:
+        return None
+
+    if percent:
+        wavesize = int(math.ceil(len(imeis) * percent / 100.0))
+    wavesize = max(1, min(wavesize or len(imeis), len(imeis)))
+    waves = int(math.ceil(len(imeis) / float(wavesize)))
+
+    # Waves should be samples of the cohort, not runs of serial numbers
+    random.shuffle(imeis)
+
+    with db.transaction():
+        r = Rollout.create(version=version,
+                selector=json.dumps(selector),
+                devices=len(imeis),
+                wavesize=wavesize,
+                waves=waves,
+                wave=0,
+                advance=advance,
+                state='active')
+
+        # A device is pending in at most one rollout: the newest. One held
+        # back by an older rollout keeps the deliver saved there.
+        for n in range(0, len(imeis), CHUNK):
+            chunk = imeis[n:n + CHUNK]
+            held = (Rolloutdevice
+                .select(Rolloutdevice.imei, Rolloutdevice.saved)
+                .join(Rollout, on=(Rolloutdevice.rollout == Rollout.id))
+                .where((Rolloutdevice.imei << chunk) & (Rolloutdevice.result >> None) &
+                    (Rolloutdevice.wave > Rollout.wave) & (Rollout.state << ['active', 'paused'])))
+            for d in held.naive():
+                delivers[d.imei] = d.saved
+            Rolloutdevice.delete().where((Rolloutdevice.imei << chunk) & (Rolloutdevice.result >> None)).execute()
+
+        rows = [dict(rollout=r.id, imei=imei, wave=n // wavesize, saved=delivers[imei] if n >= wavesize else None)
+            for n, imei in enumerate(imeis)]
+        for n in range(0, len(rows), CHUNK):
+            Rolloutdevice.insert_many(rows[n:n + CHUNK]).execute()
+
+        later = imeis[wavesize:]
+        for n in range(0, len(later), CHUNK):
+            deliver(Otap.imei << later[n:n + CHUNK], None)
+
+        release(r, 0)
+
+    return r
+
+def release(r, wave):
+    ''' Set deliver on the devices of `wave' '''
+
+    members = Rolloutdevice.select(Rolloutdevice.imei).where((Rolloutdevice.rollout == r.id) & (Rolloutdevice.wave == wave))
+    return deliver(Otap.imei << members, r.version)
+
+def restore(r):
+    ''' Give the devices of the waves of `r' not yet released back the
+        deliver they had before, unless it was set since. Returns how many
+        were restored. '''
+
+    held = (Rolloutdevice
+        .select(Rolloutdevice.imei, Rolloutdevice.saved)
+        .where((Rolloutdevice.rollout == r.id) & (Rolloutdevice.wave > r.wave)))
+
+    bysaved = {}
+    for d in held.naive():
+        bysaved.setdefault(d.saved, []).append(d.imei)
+
+    restored = 0
+    for saved, imeis in bysaved.items():
+        for n in range(0, len(imeis), CHUNK):
+            restored += deliver((Otap.imei << imeis[n:n + CHUNK]) & (Otap.deliver >> None), saved)
+
+    return restored
+
+def progress(r):
+    ''' Return (released, ok, failed) for the waves released so far '''
+
+    query = (Rolloutdevice
+        .select(Rolloutdevice.result)
+        .where((Rolloutdevice.rollout == r.id) & (Rolloutdevice.wave <= r.wave)))
+
+    released = ok = failed = 0
+    for d in query.naive():
+        released += 1
+        if d.result == 'ok':
+            ok += 1
+        elif d.result == 'failed':
+            failed += 1
+
+    return released, ok, failed
+
+def advance(r, force=False, canpause=True):
+    ''' Release the next wave of `r' if enough devices succeeded (or if
+        `force'), finish the rollout after the last wave, or pause it when
+        too many failed (unless not `canpause'). Returns a message describing what happened or
+        None if nothing changed. '''
+
+    if r.state != 'active' and not force:
+        return None
+
+    released, ok, failed = progress(r)
+    needed = int(math.ceil(released * r.advance / 100.0))
+
+    if ok >= needed or force:
+        if r.wave + 1 >= r.waves:
+            if ok >= needed:
+                Rollout.update(state='done').where(Rollout.id == r.id).execute()
+                return "Rollout {0} of {1} done: {2}/{3} devices upgraded".format(r.id, r.version, ok, released)
+            return None
+
+        # Several workers may get here for the same notify storm; only the
+        # one whose UPDATE matches the current wave releases the next one
+        nrows = (Rollout.update(wave=r.wave + 1)
+            .where((Rollout.id == r.id) & (Rollout.wave == r.wave) & (Rollout.state << ['active', 'paused']))
+            .execute())
+        if nrows != 1:
+            return None
+
+        r.wave += 1
+        n = release(r, r.wave)
+        return "Rollout {0} of {1}: wave {2}/{3} released to {4} devices ({5}/{6} upgraded so far)".format(
+            r.id, r.version, r.wave + 1, r.waves, n, ok, released)
+
+    if canpause and failed > released - needed:
+        Rollout.update(state='paused').where((Rollout.id == r.id) & (Rollout.state == 'active')).execute()
+        return "Rollout {0} of {1} paused: {2}/{3} devices failed in wave {4}".format(
+            r.id, r.version, failed, released, r.wave + 1)
+
+    return None
+
+def record(imei, result):
+    ''' Record the OTAP `result' notified by `imei' against the rollout in
+        which it is pending, if any, and advance that rollout. The result
+        is recorded whatever state the rollout is in: a device released
+        before a pause notifies only once, and must count after resume.
+        Returns a message if the rollout changed, else None. '''
+
+    query = (Rolloutdevice
+        .select(Rolloutdevice)
+        .join(Rollout, on=(Rolloutdevice.rollout == Rollout.id))
+        .where((Rolloutdevice.imei == imei) & (Rolloutdevice.result >> None) & (Rolloutdevice.wave <= Rollout.wave))
+        )
+
+    try:
+        d = query.get()
+    except Rolloutdevice.DoesNotExist:
+        return None
+
+    outcome = 'ok' if succeeded(result) else 'failed'
+    Rolloutdevice.update(result=outcome).where(Rolloutdevice.id == d.id).execute()
+
+    return advance(Rollout.get(Rollout.id == d.rollout))
+
+class Results(WriteBehind):
+    ''' OTAP results notified while the database couldn't be used, queued
+        as (imei, result) rows and recorded with record() once it can be.
+        Rows which fail because the database is still unavailable are kept
+        as WriteBehind keeps them; recording a result twice is harmless as
+        only pending devices match. `onchange' is called with the message
+        of every rollout which changed. '''
+
+    def __init__(self, onchange=None, **kwargs):
+        WriteBehind.__init__(self, Rolloutdevice, **kwargs)
+        self.name = 'rollout-results'
+        self.onchange = onchange
+
+    def insert(self, rows):
+        dbconn()
+        try:
+            for row in rows:
+                message = record(row['imei'], row['result'])
+                if message is not None and self.onchange is not None:
+                    self.onchange(message)
+        finally:
+            dbclose()
+
+def control(rid, action):
+    ''' pause, resume, advance (release the next wave now) or abort
+        (release no more waves) rollout `rid'. Returns a message. '''
+
+    try:
+        r = Rollout.get(Rollout.id == rid)
+    except Rollout.DoesNotExist:
+        return "No rollout {0}".format(rid)
+
+    if r.state in ('done', 'aborted'):
+        return "Rollout {0} is {1}".format(rid, r.state)
+
+    if action == 'pause':
+        Rollout.update(state='paused').where(Rollout.id == rid).execute()
+        return "Rollout {0} of {1} paused".format(rid, r.version)
+
+    if action == 'abort':
+        with db.transaction():
+            Rollout.update(state='aborted').where(Rollout.id == rid).execute()
+            n = restore(r)
+        return "Rollout {0} of {1} aborted; {2} held back devices restored".format(rid, r.version, n)
+
+    if action == 'resume':
+        Rollout.update(state='active').where(Rollout.id == rid).execute()
+        r.state = 'active'
+        return advance(r, canpause=False) or "Rollout {0} of {1} resumed".format(rid, r.version)
+
+    if action == 'advance':
+        return advance(r, force=True) or "Rollout {0} of {1} has no more waves".format(rid, r.version)
+
+    return "Unknown rollout action {0}".format(action)
+
+def status():
+    ''' Return a list of dicts describing all rollouts, newest first '''
+
+    rollouts = []
+    for r in Rollout.select().order_by(Rollout.id.desc()):
+        released, ok, failed = progress(r)
+        rollouts.append({
+            'id'        : r.id,
+            'version'   : r.version,
+            'selector'  : r.selector,
+            'state'     : r.state,
+            'devices'   : r.devices,
+            'wave'      : r.wave + 1,
+            'waves'     : r.waves,
+            'wavesize'  : r.wavesize,
+            'advance'   : r.advance,
+            'released'  : released,
+            'ok'        : ok,
+            'failed'    : failed,
+            'created'   : str(r.created),
+        })
+
+    return rollouts
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import os
+import time
+import json
+import logging
+from owntracks.dbschema import dbconn, dbclose
+from owntracks.writebehind import Flusher
+
+log = logging.getLogger(__name__)
+
+# While the database can't be used, the device-facing routes answer from a
+# snapshot of every device's state (custid, deliver, block, settings, ...)
+# taken every `interval' seconds. With a `path', the snapshot is also kept
+# in that JSON file: workers on a host read the one written last instead of
+# each querying all devices, and a restarted server has a snapshot before
+# it has reached the database. A snapshot which can't be taken leaves the
+# previous one in place.
+
+class Snapshot(Flusher):
+
+    def __init__(self, build, path=None, interval=300):
+        Flusher.__init__(self, 'snapshot', interval)
+
+        # build() returns a dict imei -> state, as JSON-serializable dicts
+        self.build = build
+        self.path = path
+        self.devices = {}
+        self.taken = None
+        self.mtime = None
+
+        self.builds = 0
+        self.loads = 0
+        self.served = 0
+        self.failed = 0
+
+    def enabled(self):
+        return self.interval > 0
+
+    def run(self):
+        # Take the first snapshot right away, not after `interval'
+        try:
+            self.flush()
+        except Exception, e:
+            log.error("snapshot: flush failed: {0}".format(str(e)))
+        Flusher.run(self)
+
+    def flush(self):
+        with self.flushlock:
+            self.load()
+            if self.taken is not None and time.time() - self.taken < self.interval:
+                # Another worker took it
+                return
+
+            dbconn()
+            try:
+                devices = self.build()
+            except Exception, e:
+                self.failed += 1
+                log.error("snapshot: cannot read devices: {0}".format(str(e)))
+                return
+            finally:
+                dbclose()
+
+            with self.lock:
+                self.devices = devices
+                self.taken = time.time()
+            self.builds += 1
+
+            if self.path is not None:
+                self.write(devices)
+
+    def write(self, devices):
+        tmp = "{0}.{1}".format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(devices, f)
+            os.rename(tmp, self.path)
+            self.mtime = os.stat(self.path).st_mtime
+        except Exception, e:
+            log.error("snapshot: cannot write {0}: {1}".format(self.path, str(e)))
+
+    def load(self):
+        ''' Read the file at `path' if it changed since we last did '''
+
+        if self.path is None:
+            return
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path) as f:
+                devices = json.load(f)
+        except OSError:
+            return
+        except Exception, e:
+            log.error("snapshot: cannot read {0}: {1}".format(self.path, str(e)))
+            return
+
+        with self.lock:
+            self.devices = devices
+            self.taken = mtime
+            self.mtime = mtime
+        self.loads += 1
+
+    def get(self, imei):
+        ''' Return a copy of IMEI's state in the snapshot or None '''
+
+        self.load()
+        with self.lock:
+            state = self.devices.get(imei)
+        if state is None:
+            return None
+
+        self.served += 1
+        return dict(state)
+
+    def stats(self):
+        with self.lock:
+            size = len(self.devices)
+            age = int(time.time() - self.taken) if self.taken is not None else None
+
+        return {
+            'devices'   : size,
+            'age'       : age,
+            'builds'    : self.builds,
+            'loads'     : self.loads,
+            'served'    : self.served,
+            'failed'    : self.failed,
+        }
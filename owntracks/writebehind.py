@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__    = 'Jan-Piet Mens <jpmens()gmail.com>'
+__copyright__ = 'Copyright 2014 Jan-Piet Mens'
+__license__   = """Eclipse Public License - v 1.0 (http://www.eclipse.org/legal/epl-v10.html)"""
+
+import os
+import atexit
+import threading
+import logging
+from owntracks.dbschema import db, dbconn, dbclose, TRANSIENT
+
+log = logging.getLogger(__name__)
+
+# Every Flusher ever created, so that they can all be flushed at shutdown
+flushers = []
+
+# Keep multi-row INSERTs below SQLite's default limit of 999 host parameters
+MAXPARAMS = 900
+
+class Flusher(object):
+    ''' Base class for things which buffer work in memory and have it
+        written out by a background thread, either every `interval' seconds
+        or sooner when woken up. Subclasses implement flush(). '''
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flushlock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.stopping = False
+
+        flushers.append(self)
+
+    def start(self):
+        ''' Start the background thread if it isn't running in this process.
+            uWSGI forks its workers after loading the application, and a
+            thread started in the master doesn't survive the fork, so this
+            is invoked lazily on first use. '''
+
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+                return
+
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            try:
+                self.flush()
+            except Exception, e:
+                log.error("{0}: flush failed: {1}".format(self.name, str(e)))
+
+    def flush(self):
+        raise NotImplementedError
+
+    def shutdown(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join(self.interval)
+
+        try:
+            self.flush()
+        except Exception, e:
+            log.error("{0}: flush at shutdown failed: {1}".format(self.name, str(e)))
+
+class WriteBehind(Flusher):
+    ''' Buffer rows destined for `model' and INSERT them in bulk when
+        `batchsize' rows are queued or `interval' seconds have passed. At
+        most `maxqueue' rows are held; rows beyond that are dropped and
+        counted. Rows which can't be written because the database is
+        unavailable are kept and written by a later flush. '''
+
+    def __init__(self, model, batchsize=200, interval=5, maxqueue=10000):
+        Flusher.__init__(self, 'writebehind-' + model._meta.db_table, interval)
+
+        self.model = model
+        self.batchsize = max(1, batchsize)
+        self.maxqueue = maxqueue
+        self.fields = [f for f in model._meta.fields if f != 'id']
+        self.queue = []
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self.flushes = 0
+        self.overflow = 0       # dropped since the last report
+
+    def put(self, item):
+        ''' Queue a row. `item' may contain keys which aren't columns of the
+            model; these are ignored. '''
+
+        self.start()
+
+        row = dict((k, item[k]) for k in self.fields if k in item)
+
+        with self.lock:
+            if len(self.queue) >= self.maxqueue:
+                self.dropped += 1
+                self.overflow += 1
+                if self.overflow == 1:
+                    log.warning("{0}: queue full ({1} rows); dropping".format(self.name, self.maxqueue))
+                return False
+
+            self.queue.append(row)
+            if len(self.queue) >= self.batchsize:
+                self.wakeup.set()
+
+        return True
+
+    def pending(self):
+        ''' Return a copy of the rows not yet written, oldest first '''
+
+        with self.lock:
+            return list(self.queue)
+
+    def flush(self):
+        ''' Write everything queued so far in batches of `batchsize' rows. '''
+
+        with self.flushlock:
+            with self.lock:
+                if self.overflow:
+                    log.error("{0}: {1} rows dropped because the queue was full".format(self.name, self.overflow))
+                    self.overflow = 0
+
+            while True:
+                with self.lock:
+                    rows = self.queue[:self.batchsize]
+                    del self.queue[:self.batchsize]
+                if not rows:
+                    break
+
+                try:
+                    self.insert(rows)
+                    self.written += len(rows)
+                except TRANSIENT, e:
+                    self.retain(rows)
+                    log.error("{0}: cannot INSERT {1} rows; keeping them: {2}".format(self.name, len(rows), str(e)))
+                    self.flushes += 1
+                    break
+                except Exception, e:
+                    self.failed += len(rows)
+                    log.error("{0}: cannot INSERT {1} rows: {2}".format(self.name, len(rows), str(e)))
+
+                self.flushes += 1
+
+    def retain(self, rows):
+        ''' Put `rows' back at the head of the queue, dropping the newest
+            rows if that makes it longer than `maxqueue' '''
+
+        with self.lock:
+            self.queue[:0] = rows
+            excess = len(self.queue) - self.maxqueue
+            if excess > 0:
+                del self.queue[-excess:]
+                self.dropped += excess
+            self.retried += len(rows)
+
+    def insert(self, rows):
+        step = max(1, MAXPARAMS // len(self.fields))
+
+        dbconn()
+        try:
+            with db.transaction():
+                for n in range(0, len(rows), step):
+                    self.model.insert_many(rows[n:n + step]).execute()
+        finally:
+            dbclose()
+
+    def stats(self):
+        with self.lock:
+            queued = len(self.queue)
+
+        return {
+            'queued'    : queued,
+            'written'   : self.written,
+            'dropped'   : self.dropped,
+            'failed'    : self.failed,
+            'retried'   : self.retried,
+            'flushes'   : self.flushes,
+        }
+
+class Coalescer(Flusher):
+    ''' Collect column updates for rows of `model' identified by `keyfield'
+        and apply them every `interval' seconds. Repeated updates to the same
+        row are coalesced so that only the most recent value of each column
+        is written, and rows receiving the same value are changed by a single
+        set-based UPDATE ... WHERE key IN (...). Updates which can't be made
+        because the database is unavailable are kept for the next flush.
+        After each flush, `onwrite' (if given) is called with the updates
+        written, a dict key -> {column: value}. '''
+
+    def __init__(self, model, keyfield, interval=30, onwrite=None):
+        Flusher.__init__(self, 'coalesce-' + model._meta.db_table, interval)
+
+        self.model = model
+        self.keyfield = keyfield
+        self.onwrite = onwrite
+        self.rows = {}
+
+        self.updated = 0
+        self.statements = 0
+        self.failed = 0
+        self.retried = 0
+
+    def put(self, key, **values):
+        self.start()
+
+        with self.lock:
+            self.rows.setdefault(key, {}).update(values)
+
+    def pending(self, key):
+        ''' Return a dict of the column values not yet written for `key' '''
+
+        with self.lock:
+            return dict(self.rows.get(key, {}))
+
+    def discard(self, column, keys=None):
+        ''' Forget the pending value of `column' for `keys' (all if None),
+            e.g. because the column was just updated directly '''
+
+        with self.lock:
+            for key in (self.rows.keys() if keys is None else keys):
+                values = self.rows.get(key)
+                if values is not None:
+                    values.pop(column, None)
+                    if not values:
+                        del self.rows[key]
+
+    def flush(self):
+        with self.flushlock:
+            with self.lock:
+                rows = self.rows
+                self.rows = {}
+            if not rows:
+                return
+
+            # Group keys by (column, value) so that each group is one UPDATE
+            groups = {}
+            for key, values in rows.iteritems():
+                for column, value in values.iteritems():
+                    groups.setdefault((column, value), []).append(key)
+
+            try:
+                self.update(groups)
+                self.updated += len(rows)
+            except TRANSIENT, e:
+                self.retain(rows)
+                log.error("{0}: cannot UPDATE {1} rows; keeping them: {2}".format(self.name, len(rows), str(e)))
+                return
+            except Exception, e:
+                self.failed += len(rows)
+                log.error("{0}: cannot UPDATE {1} rows: {2}".format(self.name, len(rows), str(e)))
+                return
+
+            if self.onwrite is not None:
+                self.onwrite(rows)
+
+    def retain(self, rows):
+        ''' Merge the updates of `rows' back in under those made since '''
+
+        with self.lock:
+            for key, values in rows.iteritems():
+                values = dict(values)
+                values.update(self.rows.get(key, {}))
+                self.rows[key] = values
+            self.retried += len(rows)
+
+    def update(self, groups):
+        dbconn()
+        try:
+            with db.transaction():
+                for (column, value), keys in groups.iteritems():
+                    for n in range(0, len(keys), MAXPARAMS):
+                        query = self.model.update(**{column: value}).where(self.keyfield << keys[n:n + MAXPARAMS])
+                        query.execute()
+                        self.statements += 1
+        finally:
+            dbclose()
+
+    def stats(self):
+        with self.lock:
+            queued = len(self.rows)
+
+        return {
+            'queued'        : queued,
+            'updated'       : self.updated,
+            'statements'    : self.statements,
+            'failed'        : self.failed,
+            'retried'       : self.retried,
+        }
+
+def shutdown():
+    ''' Flush whatever is still buffered. Registered with atexit, and should
+        also be installed as uwsgi.atexit when running under uWSGI. '''
+
+    for f in flushers:
+        f.shutdown()
+
+atexit.register(shutdown)